@@ -0,0 +1,51 @@
+'''
+Times modified_utf8 against the per-byte loops it replaced (see fuzz_modified_utf8.py), in both directions.
+
+Usage: python benchmarks/bench_modified_utf8.py [repeats]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import modified_utf8
+from fuzz_modified_utf8 import old_utf8m_to_utf8s
+from fuzz_modified_utf8 import old_utf8s_to_utf8m
+
+# (name, utf8 input), roughly what goes through the console: mostly ASCII lines, some with other characters.
+inputs = [
+    ('ascii line', '[12:00:01] [Server thread/INFO]: Alex has made the advancement [Stone Age]'.encode('utf-8')),
+    ('ascii log', ('[12:00:01] [Server thread/INFO]: Saved the game\n' * 1400).encode('utf-8')),
+    ('mixed log', ('<Alex> café 你好 \U0001F600 ok\x00\n' * 2000).encode('utf-8')),
+]
+
+
+def timed(fn, data, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print('best of %d runs' % repeats)
+    for name, utf8s in inputs:
+        utf8m = old_utf8s_to_utf8m(utf8s)
+        for direction, new, old, data in [
+            ('s->m', modified_utf8.utf8s_to_utf8m, old_utf8s_to_utf8m, utf8s),
+            ('m->s', modified_utf8.utf8m_to_utf8s, old_utf8m_to_utf8s, utf8m),
+        ]:
+            old_time = timed(old, data, repeats)
+            new_time = timed(new, data, repeats)
+            print('  %-13s %s %7d bytes: old %10.1f us, new %8.1f us (%.0fx)' % (name, direction, len(data),
+                  old_time * 1e6, new_time * 1e6, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
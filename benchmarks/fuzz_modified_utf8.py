@@ -0,0 +1,140 @@
+'''
+Checks that modified_utf8 converts exactly like the per-byte loops it replaced (kept below as the oracle), in both
+directions, on random strings mixing ASCII, NULL, 2byte, 3byte and 4byte characters.
+
+Usage: python benchmarks/fuzz_modified_utf8.py [amount] [seed]
+'''
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import modified_utf8
+
+# --- The old conversion (oracle) ---
+
+def old_utf8s_to_utf8m(string):
+    new_str = []
+    i = 0
+    while i < len(string):
+        byte1 = string[i]
+        if (byte1 & 0x80) == 0:
+            if byte1 == 0:
+                new_str.append(0xC0)
+                new_str.append(0x80)
+            else:
+                new_str.append(byte1)
+        elif (byte1 & 0xE0) == 0xC0:
+            new_str.append(byte1)
+            i += 1
+            new_str.append(string[i])
+        elif (byte1 & 0xF0) == 0xE0:
+            new_str.append(byte1)
+            i += 1
+            new_str.append(string[i])
+            i += 1
+            new_str.append(string[i])
+        elif (byte1 & 0xF8) == 0xF0:
+            i += 1
+            byte2 = string[i]
+            i += 1
+            byte3 = string[i]
+            i += 1
+            byte4 = string[i]
+            u21 = (byte1 & 0x07) << 18
+            u21 += (byte2 & 0x3F) << 12
+            u21 += (byte3 & 0x3F) << 6
+            u21 += (byte4 & 0x3F)
+            new_str.append(0xED)
+            new_str.append((0xA0 + (((u21 >> 16) - 1) & 0x0F)))
+            new_str.append((0x80 + ((u21 >> 10) & 0x3F)))
+            new_str.append(0xED)
+            new_str.append((0xB0 + ((u21 >> 6) & 0x0F)))
+            new_str.append(byte4)
+        i += 1
+    return bytes(new_str)
+
+
+def old_utf8m_to_utf8s(string):
+    new_string = []
+    length = len(string)
+    i = 0
+    while i < length:
+        byte1 = string[i]
+        if (byte1 & 0x80) == 0:
+            new_string.append(byte1)
+        elif (byte1 & 0xE0) == 0xC0:
+            i += 1
+            byte2 = string[i]
+            if byte1 != 0xC0 or byte2 != 0x80:
+                new_string.append(byte1)
+                new_string.append(byte2)
+            else:
+                new_string.append(0)
+        elif (byte1 & 0xF0) == 0xE0:
+            i += 1
+            byte2 = string[i]
+            i += 1
+            byte3 = string[i]
+            if i+3 < length and byte1 == 0xED and (byte2 & 0xF0) == 0xA0:
+                byte4 = string[i+1]
+                byte5 = string[i+2]
+                byte6 = string[i+3]
+                if byte4 == 0xED and (byte5 & 0xF0) == 0xB0:
+                    i += 3
+                    u21 = ((byte2 & 0x0F) + 1) << 16
+                    u21 += (byte3 & 0x3F) << 10
+                    u21 += (byte5 & 0x0F) << 6
+                    u21 += (byte6 & 0x3F)
+                    new_string.append(0xF0 + ((u21 >> 18) & 0x07))
+                    new_string.append(0x80 + ((u21 >> 12) & 0x3F))
+                    new_string.append(0x80 + ((u21 >> 6) & 0x3F))
+                    new_string.append(0x80 + (u21 & 0x3F))
+                    continue
+            new_string.append(byte1)
+            new_string.append(byte2)
+            new_string.append(byte3)
+        i += 1
+    return bytes(new_string)
+
+# --- Input ---
+
+# (weight, lowest, highest code point), surrogates are left out (str.encode refuses them).
+ranges = [(50, 0x20, 0x7E), (5, 0x00, 0x00), (5, 0x01, 0x1F), (10, 0x80, 0x7FF), (10, 0x800, 0xD7FF), (5, 0xE000, 0xFFFF), (15, 0x10000, 0x10FFFF)]
+
+def random_string(rnd, max_length):
+    weights = [r[0] for r in ranges]
+    chars = []
+    for _, lo, hi in rnd.choices(ranges, weights, k=rnd.randint(0, max_length)):
+        chars.append(chr(rnd.randint(lo, hi)))
+    return ''.join(chars)
+
+
+def main():
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    rnd = random.Random(seed)
+    failures = 0
+    for n in range(amount):
+        # Every 4th string is plain ASCII, which takes the shortcut of the new code.
+        s = random_string(rnd, 64) if n % 4 else ''.join(chr(rnd.randint(0x20, 0x7E)) for _ in range(rnd.randint(0, 64)))
+        utf8s = s.encode('utf-8')
+        utf8m = old_utf8s_to_utf8m(utf8s)
+        checks = [
+            ('utf8s_to_utf8m', utf8s, modified_utf8.utf8s_to_utf8m(utf8s), utf8m),
+            ('utf8m_to_utf8s', utf8m, modified_utf8.utf8m_to_utf8s(utf8m), old_utf8m_to_utf8s(utf8m)),
+            ('round trip', utf8s, modified_utf8.utf8m_to_utf8s(modified_utf8.utf8s_to_utf8m(utf8s)), utf8s),
+        ]
+        for name, data, got, expected in checks:
+            if got != expected:
+                failures += 1
+                if failures <= 5:
+                    print('%s differs for %r\n  got:      %r\n  expected: %r' % (name, data, got, expected))
+    print('%d strings (seed %d), %d failures' % (amount, seed, failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,10 +4,8 @@ import os
 import time
 
 from pycraft_module import PCMod
-from mcstatus import MinecraftServer
 from threading import Thread
 from threading import Event
-from threading import Timer
 
 description = "Tool to automatically shutdown the server."
 patterns = ['as', 'auto-shutdown']
@@ -17,36 +15,17 @@ def get_module():
 
 exit_event = Event()
 server_status_thread = None
+player_subscription = None # Join and leave events, waking up the watchdog.
+reconcile_delay = 300 # Seconds between status queries correcting the online players, in case an event was missed.
 
-class MyTimer(Timer):
-    start_time = None
-    last_time = None
-    started = False
-    
-    def __init__(self, t, target, args, actual_t):
-        super().__init__(t, target, args)
-        self.last_time = actual_t
-
-    def start(self):
-        self.start_time = time.time()
-        self.started = True
-        Timer.start(self)
-
-    def elapsed(self):
-        return time.time() - self.start_time
-
-    def remaining(self):
-        return self.last_time - self.elapsed()
-
-timer = None
+deadline = None # time.time() of the scheduled shutdown, None if there is none.
+shutdown_jobs = [] # The jobs announcing and counting down the shutdown.
+idle_time = None # Seconds without players before the shutdown, while the watchdog runs.
 hard = False
 
 def close():
-    global timer
     stop_watchdog()
-    if not (timer is None):
-        timer.cancel()
-        timer = None
+    cancel_shutdown()
 
 def usage(subcmd=[]):
     return """Usage:   as|auto-shutdown <SUBCOMMANDS>
@@ -60,37 +39,40 @@ Subcommands include:
 def pyprint(string, loglevel=1):
     get_module().pyprint(string, loglevel)
 
-def server_status(port, t, run_cmd):
-    global timer
-    poll_delay = max(10, min(t // 10, 120))
-
-    def reset_timer():
-        global timer
-
-        if t > 59: timer = MyTimer(max(0, t - 60), start_countdown, [60, run_cmd], t)
-        else: timer = MyTimer(max(0, t - 10), start_countdown, [min(10, int(t)), run_cmd], t)
-
-    server = MinecraftServer.lookup('127.0.0.1:%s' % port)
-    reset_timer()
+def reconcile_players(port, players):
+    '''
+    Corrects the online players tracked from the join and leave events with a status query.
+    '''
+    from mcstatus import MinecraftServer # Slow to import, only when needed.
+    try:
+        status = MinecraftServer.lookup('127.0.0.1:%s' % port).status().players
+    except ConnectionRefusedError:
+        pyprint("Could not connect to the server!", 3)
+        return
+    except IOError:
+        pyprint("Server is not ready yet!", 3)
+        return
+    if players.reconcile(status.online, [p.name for p in status.sample or []]):
+        pyprint('Corrected the amount of players online to %d.' % status.online, 0)
+
+def server_status(port, t, run_cmd, players, subscription):
+    '''
+    Watches the players online (woken up by every join and leave), starts the countdown when the last player left and
+    cancels it when a player joins.
+    '''
+    reconcile_players(port, players)
     while not exit_event.is_set():
-        try:
-            status = server.status().players.online
-            if status < 1 and not timer.started:
-                run_cmd("say [Auto Shutdown] No players online, will shutdown in %s from now!" % pretty_time(t))
-                timer.start()
-            elif status > 0 and timer.started:
-                pyprint('Shutdown canceled, because of player login.')
-                timer.cancel()
-                reset_timer()
-        except ConnectionRefusedError:
-            pyprint("Could not connect to the server!", 3)
-        except IOError:
-            pyprint("Server is not ready yet!", 3)
-
-        exit_event.wait(poll_delay)
-    if not (timer is None):
-        timer.cancel()
-        timer = None
+        online = players.count()
+        if online < 1 and deadline is None:
+            run_cmd("say [Auto Shutdown] No players online, will shutdown in %s from now!" % pretty_time(t))
+            schedule_shutdown(t, run_cmd)
+        elif online > 0 and deadline is not None:
+            pyprint('Shutdown canceled, because of player login.')
+            cancel_shutdown()
+
+        if subscription.get(reconcile_delay) is None and not exit_event.is_set():
+            reconcile_players(port, players)
+    cancel_shutdown()
 
 def pretty_time(t):
     if (t == 1): st = '1 second'
@@ -100,33 +82,33 @@ def pretty_time(t):
     return st
 
 def stop_watchdog():
-    global server_status_thread
+    global server_status_thread, player_subscription, idle_time
     if server_status_thread is not None:
         exit_event.set()
+        player_subscription.close() # Wakes up the watchdog.
+        player_subscription = None
         server_status_thread.join()
         exit_event.clear()
         server_status_thread = None
+        idle_time = None
         pyprint('Player watchdog has been turned off.')
 
-def command_parser(cmd, server_config, run_cmd, event_triggers):
-    global hard, timer, server_status_thread
+def command_parser(cmd, server_config, run_cmd, event_bus):
+    global hard, server_status_thread, player_subscription, idle_time
 
     key, sub = pu.next_cmd(cmd)
     if key == "query":
         if pu.max_cmd_len(sub, 0, pyprint): return
-        if timer is None:
-            pyprint("No shutdown is currently scheduled.")
+        if deadline is not None:
+            pyprint("%s before shutdown!" % pretty_time(max(0, deadline - time.time())))
+        elif idle_time is not None:
+            pyprint("Idle timer set to %s! (players online might prevent countdown)" % pretty_time(idle_time))
         else:
-            if timer.started:
-                pyprint("%s before shutdown!" % pretty_time(timer.remaining()))
-            else:
-                pyprint("Idle timer set to %s! (players online might prevent countdown)" % pretty_time(timer.last_time))
+            pyprint("No shutdown is currently scheduled.")
     elif key == "cancel":
         if pu.max_cmd_len(sub, 0, pyprint): return
         v = False
-        if not (timer is None):
-            timer.cancel()
-            timer = None
+        if cancel_shutdown():
             run_cmd("say [Auto Shutdown] Automatic shutdown was canceled!")
             v = True
         if server_status_thread is not None:
@@ -148,13 +130,9 @@ def command_parser(cmd, server_config, run_cmd, event_triggers):
             if (hard):
                 pyprint('HARD parameter has been set. The system will shutdown in 30 seconds after the server is closed.', 2)
             stop_watchdog()
-            if not (timer is None):
-                timer.cancel()
+            if cancel_shutdown():
                 pyprint('Previous scheduled shutdown was replaced.', 1)
-            
-            if t > 59: timer = MyTimer(max(0, t - 60), start_countdown, [60, run_cmd], t)
-            else: timer = MyTimer(max(0, t - 10), start_countdown, [min(10, int(t)), run_cmd], t)
-            timer.start()
+            schedule_shutdown(t, run_cmd)
 
             run_cmd("say [Auto Shutdown] Server scheduled to close in %s!" % pretty_time(t))
         except Exception:
@@ -172,12 +150,13 @@ def command_parser(cmd, server_config, run_cmd, event_triggers):
             hard = True if len(sub2) > 0 and sub2[0] == 'HARD' else False
             if (hard):
                 pyprint('HARD parameter has been set. The system will shutdown in 30 seconds after the server is closed.', 2)
-            if not (timer is None):
-                timer.cancel()
+            if cancel_shutdown():
                 pyprint('Previous scheduled shutdown was replaced.', 1)
             stop_watchdog()
             
-            server_status_thread = Thread(target=server_status, args=(server_config['port'], t, run_cmd))
+            idle_time = t
+            player_subscription = event_bus.subscribe(['join', 'leave'])
+            server_status_thread = Thread(target=server_status, args=(server_config['port'], t, run_cmd, event_bus.players, player_subscription))
             server_status_thread.daemon = True
             server_status_thread.start()
 
@@ -188,32 +167,46 @@ def command_parser(cmd, server_config, run_cmd, event_triggers):
         pyprint(usage())
 
 def shutdown_server(run_cmd):
+    cancel_shutdown()
     stop_watchdog()
     run_cmd("say [Auto Shutdown] Server shutting down!")
     run_cmd("stop")
     if hard: shutdown_pc()
 
-def start_countdown(t, run_cmd, poll_players_server=None):
-    global timer, running, server_status_thread
-
-    if not (poll_players_server is None) and t % 2 == 0:
-        try:
-            status = poll_players_server.status().players.online
-            if status > 0:
-                run_cmd("say [Auto Shutdown] Automatic shutdown was canceled, because a player logged in!")
-                return
-        except (ConnectionRefusedError, IOError):
-            pyprint("No server response!", 3)
-    if (t == 0):
-        shutdown_server(run_cmd)
-    elif (t == 60):
-        run_cmd("say [Auto Shutdown] Server will automatically close in %s!" % pretty_time(t))
-        timer = MyTimer(50, start_countdown, [10, run_cmd, poll_players_server], t)
-        timer.start()
+def schedule_shutdown(t, run_cmd):
+    '''
+    Schedules the shutdown in t seconds. It is announced a minute before, and counted down every second for the last
+    10 seconds (by a single fixed-rate job).
+    '''
+    global deadline, shutdown_jobs
+    cancel_shutdown()
+    deadline = time.time() + t
+    jobs = []
+    if t > 59:
+        jobs.append(get_module().schedule_once(t - 60, lambda: run_cmd("say [Auto Shutdown] Server will automatically close in %s!" % pretty_time(60)), 'shutdown warning'))
+    jobs.append(get_module().schedule_every(1, lambda: countdown(run_cmd), 'shutdown countdown', max(0, t - 10)))
+    shutdown_jobs = jobs
+
+def countdown(run_cmd):
+    if deadline is None:
+        return
+    left = round(deadline - time.time())
+    if left > 0:
+        run_cmd("say [Auto Shutdown] Server closes in %s..." % pretty_time(left))
     else:
-        run_cmd("say [Auto Shutdown] Server closes in %s..." % pretty_time(t))
-        timer = MyTimer(1, start_countdown, [t - 1, run_cmd, poll_players_server], t)
-        timer.start()
+        shutdown_server(run_cmd)
+
+def cancel_shutdown():
+    '''
+    Cancels the scheduled shutdown, returns True if there was one.
+    '''
+    global deadline, shutdown_jobs
+    for job in shutdown_jobs:
+        job.cancel()
+    shutdown_jobs = []
+    scheduled = deadline is not None
+    deadline = None
+    return scheduled
 
 def shutdown_pc():
     pyprint(' --- INITIATING FULL SYSTEM SHUTDOWN IN 30 SECONDS AS REQUESTED! --- ', 3)
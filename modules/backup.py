@@ -1,15 +1,11 @@
 import pycraft_utils as pu
+import pycraft_store as ps
 import subprocess
-import tempfile
-import zipfile
-import shutil
 import time
 import os
 
-from multiprocessing import Process
 from pycraft_module import PCMod
 from datetime import datetime
-from threading import Timer
 from threading import Lock
 from os import path
 
@@ -21,16 +17,28 @@ seven_zip_exe = "7z" # Set to absolute path if not in %PATH% variable.
 backup_method_initialized = False
 use_7z = True
 fast_backup = True
-
-timer = None
+zip_workers = os.cpu_count() or 1 # Processes compressing the files of a zipfile backup.
+compression_level = 6 # Deflate level (0-9) of a zipfile backup.
+backup_mode = 'zip' # 'zip': every backup is an archive, 'store': every backup is a snapshot in the backup store,
+                    # 'chunks': as store, but region files are stored per chunk.
+backup_modes = ['zip', 'store', 'chunks']
+
+schedule_job = None # The job of the automatic backups.
+postpone_job = None # An automatic backup postponed because of lag.
+schedule = None # (interval, amount) of the automatic backups, handed over on reload.
+lag_quiet_time = 60 # Automatic backups wait until the server didn't lag for this many seconds,
+max_postpones = 10 # but no more than this many times.
 min_b_time = 120 # 5 minutes
 running = True
-save_event = None
+save_subscription = None
 
 DEFAULT_MODULE_DATA = {
     'use-7z': use_7z,
     'quick-backup': fast_backup,
-    '7z-path': seven_zip_exe
+    '7z-path': seven_zip_exe,
+    'workers': zip_workers,
+    'compression-level': compression_level,
+    'mode': backup_mode
 }
 
 backup_lock = Lock()
@@ -39,12 +47,13 @@ def get_module():
     return module
 
 def usage(subcmd=[]):
-    return """Usage:   backup <now|schedule|off>: Create/schedule backups.
+    return """Usage:   backup <now|schedule|off|restore>: Create/schedule/restore backups.
 
 Subcommands:
  - now [END]: Create a manual backup right now. Specify `END` to also stop the server.
  - schedule <TIME<m|h>> [AMOUNT]: Schedule backup every TIME, up to AMOUNT automatic backups to keep (default 1).
  - off: Turn automatic backups off.
+ - restore <NAME>: Rebuild the snapshot NAME (backup store only) under the folder 'backups/restore'.
 
 Backups are saved per server configuration under the folder 'backups'. Automatic backups will be under 'backups/auto'"""
 
@@ -65,6 +74,8 @@ def world_7z(world, new_backup_zip, auto=False):
         if file.startswith(f"{universe_name}_{world_name}_") and file.endswith('.zip'):
             backups.append(file)
 
+    import tempfile
+    import shutil
     with tempfile.TemporaryDirectory() as temp_folder:
         # Update existing backup file and add disk_exist_ar_not, remove ar_exist_disk_not, replace disk_new, keep ar_new, keep ar_same, replace disk_diff
         if fast_backup and len(backups) > 0:
@@ -97,20 +108,18 @@ def zip_method(world, zip_folder, auto):
     return (world_7z(world, zip_folder, auto) if use_7z else zip_world(world, zip_folder))
 
 def close():
-    global running, timer
+    global running
     running = False
     if backup_lock.locked():
         pyprint('Waiting for backup to finish...')
-        if not (save_event is None):
-            save_event.set()
+        if not (save_subscription is None):
+            save_subscription.close()
     backup_lock.acquire()
-    if not (timer is None):
-        timer.cancel()
-        timer = None
+    cancel_schedule()
     backup_lock.release()
 
 def set_environment(server_config):
-    global backup_folder, auto_backup_folder, world_folder, universe_name, world_name, use_7z, fast_backup, backup_method_initialized
+    global backup_folder, auto_backup_folder, store_folder, world_folder, universe_name, world_name, use_7z, fast_backup, zip_workers, compression_level, backup_mode, backup_method_initialized
 
     if not backup_method_initialized:
         world_folder = server_config['world-root']
@@ -118,11 +127,18 @@ def set_environment(server_config):
         world_name = server_config['world']
         backup_folder = path.join(server_config['server-root'], 'backups')
         auto_backup_folder = path.join(backup_folder, 'auto')
+        store_folder = path.join(backup_folder, 'store')
         
         backup_module_data = server_config.get('module-data', {}).get('module_backup', DEFAULT_MODULE_DATA)
         seven_zip_exe = str(backup_module_data.get('7z-path', '7z'))
         use_7z = bool(backup_module_data.get('prefer-7z', True)) and (subprocess.call([seven_zip_exe], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT) == 0)
         fast_backup = bool(backup_module_data.get('fast-backup', True))
+        zip_workers = max(1, int(backup_module_data.get('workers', os.cpu_count() or 1)))
+        compression_level = min(9, max(0, int(backup_module_data.get('compression-level', 6))))
+        backup_mode = str(backup_module_data.get('mode', 'zip'))
+        if backup_mode not in backup_modes:
+            pyprint(f'Unknown backup mode "{backup_mode}", using zip. (Options: {", ".join(backup_modes)})', 2)
+            backup_mode = 'zip'
 
         backup_method_initialized = True
 
@@ -135,24 +151,47 @@ def pretty_time(t):
     else: st = '%.2f hours' % (t / 3600.0)
     return st
 
-def callback(cmd, server_config, run_cmd, event_triggers):
-    global timer, save_event
+def cancel_schedule():
+    '''
+    Cancels the automatic backups, returns True if they were scheduled.
+    '''
+    global schedule_job, postpone_job, schedule
+    if postpone_job is not None:
+        postpone_job.cancel()
+        postpone_job = None
+    if schedule_job is None:
+        return False
+    schedule_job.cancel()
+    schedule_job = None
+    schedule = None
+    return True
+
+def start_schedule(tm, amount, run_cmd, event_bus):
+    global schedule_job, schedule
+    schedule_job = module.schedule_every(tm, lambda: schedule_backup(amount, run_cmd, event_bus), 'automatic backup')
+    schedule = (tm, amount)
+
+def callback(cmd, server_config, run_cmd, event_bus):
     set_environment(server_config)
 
-    save_event = event_triggers['save'].event
     h, t = pu.next_cmd(cmd)
     if h == 'now':
-        make_backup(run_cmd, save_event)
+        make_backup(run_cmd, event_bus)
         h2, t2 = pu.next_cmd(t)
         if (h2 == 'END'):
             run_cmd("stop")
     elif h == 'off':
-        if not (timer is None):
-            timer.cancel()
-            timer = None
+        if cancel_schedule():
             pyprint('Auto-backups is turned off.')
         else:
             pyprint('Could not turn off backups as none were scheduled.', 2)
+    elif h == 'restore':
+        h2, t2 = pu.next_cmd(t)
+        if h2 is None:
+            pyprint('The name of the snapshot is required.', 3)
+            return
+        if pu.max_cmd_len(t2, 0, pyprint): return
+        restore_snapshot(h2)
     elif h == 'schedule':
         h2, t2 = pu.next_cmd(t)
         h3, t3 = pu.next_cmd(t2)
@@ -167,65 +206,120 @@ def callback(cmd, server_config, run_cmd, event_triggers):
         amount = 1
         if not (h3 is None) and int(h3) > 0:
             amount = int(h3)
-        if not (timer is None):
-            timer.cancel()
-            timer = None
+        if cancel_schedule():
             pyprint('Replaced previous backup schedule.')
-        timer = Timer(tm, schedule_backup, [tm, amount, run_cmd, save_event])
-        timer.start()
+        start_schedule(tm, amount, run_cmd, event_bus)
         pyprint('Backup has been scheduled to run every %s (max: %s backup%s)!' % (pretty_time(tm), amount, 's' if amount > 1 else ''))
 
+def backup_extension():
+    return '.zip' if backup_mode == 'zip' else '.json'
+
+def snapshots():
+    '''
+    Returns the manifests of all snapshots in the backup store (of any world).
+    '''
+    return [path.join(folder, f) for folder in (backup_folder, auto_backup_folder) for f in os.listdir(folder) if f.endswith('.json')]
+
 def truncate(max_auto_backups):
+    removed = False
     while True:
         files = os.listdir(auto_backup_folder)
         backups = []
         for file in files:
-            if file.startswith(f"{universe_name}_{world_name}_") and file.endswith('_apcbkp.zip'):
+            if file.startswith(f"{universe_name}_{world_name}_") and file.endswith('_apcbkp' + backup_extension()):
                 backups.append(file)
         if len(backups) > max_auto_backups:
             of = min([path.join(auto_backup_folder, f) for f in backups], key=path.getctime)
             pyprint(f"Deleted oldest backup: {of}", 0)
             os.remove(of)
+            removed = True
         else:
             break
+    if removed and backup_mode != 'zip':
+        with backup_lock: # A running backup adds objects that no manifest refers to yet.
+            count, freed = ps.gc(store_folder, snapshots())
+        pyprint('Removed %d unused object%s from the backup store (%.1f MB).' % (count, '' if count == 1 else 's', freed / 1e6), 0)
+
+def schedule_backup(a, run_cmd, event_bus, postponed=0):
+    global postpone_job
+    if not running or schedule_job is None:
+        return
+    if postponed == 0 and postpone_job is not None and postpone_job.due is not None and not postpone_job.cancelled:
+        return # The previous backup is still postponed.
 
-def schedule_backup(t, a, run_cmd, save_event):
-    global timer
+    # A backup saves the whole world, don't add to the load while the server can't keep up.
+    if event_bus.lag.overloaded(lag_quiet_time) and postponed < max_postpones:
+        pyprint('The server is lagging, the backup is postponed by %s.' % pretty_time(lag_quiet_time), 0)
+        postpone_job = module.schedule_once(lag_quiet_time, lambda: schedule_backup(a, run_cmd, event_bus, postponed + 1), 'postponed backup')
+        return
 
-    make_backup(run_cmd, save_event, True)
+    make_backup(run_cmd, event_bus, True)
     
     # Truncate afterwards so 7z can fully utilize other backup for quick backups
     truncate(a)
     
-    if (not (timer is None) and running):
-        pyprint('Next backup is scheduled to run in %s!' % pretty_time(t))
-        timer = Timer(t, schedule_backup, [t, a, run_cmd, save_event])
-        timer.start()
-
-def root_from(world, root):
-    return root[len(world):].lstrip(path.sep)
+    if (not (schedule_job is None) and running):
+        pyprint('Next backup is scheduled to run in %s!' % pretty_time(int(schedule_job.due - time.time())))
 
 def zip_world(world, backup_zip):
     # Speedup for automatic backups.
     pyprint("Using py.stdlib: zipfile to create backup archive", 0)
-    p = Process(target=multi_zip, args=[world, backup_zip, world_name])
-    p.start()
-    p.join()
-
-def multi_zip(world, backup_zip, world_name):
-    zipf = zipfile.ZipFile(backup_zip, 'w', zipfile.ZIP_DEFLATED)
     pyprint(f'Creating backup at "{backup_zip}"')
-
-    for root, dirs, files in os.walk(world):
-        for file in files:
-            if file == "session.lock":
-                continue
-            loc = path.join(path.join(world_name, root_from(world, root)), file)
-            pyprint('Backing up: %s' % loc, 0)
-            zipf.write(path.join(root, file), loc)
-    zipf.close()
-
-def make_backup(run_cmd, save_event, auto=False):
+    # The workers live in pycraft_utils, modules are loaded per server and can't be pickled for the worker processes.
+    start = time.time()
+    try:
+        size = pu.zip_folder(world, backup_zip, world_name, ['session.lock'], zip_workers, compression_level)
+    except Exception as e:
+        pyprint(f'Could not zip the world: {e}', 3)
+        if path.exists(backup_zip):
+            os.remove(backup_zip)
+        return False
+    elapsed = max(time.time() - start, 0.001)
+    pyprint('Compressed %.1f MB in %.1fs (%.1f MB/s, %d worker%s).' % (size / 1e6, elapsed, size / 1e6 / elapsed, zip_workers, 's' if zip_workers > 1 else ''))
+    return True
+
+def store_world(world, manifest_path):
+    pyprint("Using the backup store", 0)
+    pyprint(f'Creating snapshot "{manifest_path}"')
+    manifests = [m for m in snapshots() if path.basename(m).startswith(f"{universe_name}_{world_name}_")]
+    start = time.time()
+    try:
+        previous = ps.load(max(manifests, key=path.getmtime)) if len(manifests) > 0 else None
+        stats = ps.snapshot(world, store_folder, manifest_path, previous, ['session.lock'], zip_workers, compression_level, backup_mode == 'chunks')
+    except Exception as e:
+        pyprint(f'Could not store the world: {e}', 3)
+        return False
+    elapsed = max(time.time() - start, 0.001)
+    pyprint('Stored %d files (%.1f MB), %d new or changed (%.1f MB, %.1f MB/s), %.1f MB added to the store.' % (stats.files,
+        stats.size / 1e6, stats.changed_files, stats.changed_size / 1e6, stats.changed_size / 1e6 / elapsed, stats.written / 1e6))
+    if backup_mode == 'chunks':
+        pyprint('%d chunk%s of the changed region files were new or changed.' % (stats.changed_chunks, '' if stats.changed_chunks == 1 else 's'), 0)
+    return True
+
+def restore_snapshot(name):
+    if not name.endswith('.json'):
+        name += '.json'
+    manifest_path = next((path.join(folder, name) for folder in (backup_folder, auto_backup_folder) if path.isfile(path.join(folder, name))), None)
+    if manifest_path is None:
+        pyprint(f'Snapshot "{name}" was not found in the backup store.', 3)
+        return
+    target = path.join(backup_folder, 'restore', name[:-len('.json')])
+    if path.exists(target):
+        pyprint(f'"{target}" already exists, remove it first.', 3)
+        return
+    if not backup_lock.acquire(blocking=False): # Objects may not be removed meanwhile.
+        pyprint('A backup is in progress, try again later.', 2)
+        return
+    try:
+        count = ps.restore(store_folder, ps.load(manifest_path), path.join(target, world_name))
+        pyprint(f'Restored {count} files to "{target}". Stop the server and copy the world over to use it.')
+    except Exception as e:
+        pyprint(f'Could not restore the snapshot: {e}', 3)
+    finally:
+        backup_lock.release()
+
+def make_backup(run_cmd, event_bus, auto=False):
+    global save_subscription
     if not running:
         pyprint("Can't backup while server is shutting down.", 2)
         return
@@ -235,23 +329,30 @@ def make_backup(run_cmd, save_event, auto=False):
     backup_lock.acquire()
     perf_start = time.time()
     if running:
+        # Subscribe before saving, so the save can't be missed.
+        save_subscription = event_bus.subscribe('save')
         run_cmd('save-off')
         run_cmd('save-all flush')
         pyprint('Waiting for server to finish saving...')
-        save_event.wait()
+        save_subscription.get()
+        save_subscription.close()
+        save_subscription = None
     pyprint('Performing server backup!')
 
     today = datetime.now()
     df = today.strftime("%Y-%m-%d_%H-%M-%S")
 
     if auto:
-        zip_name = f"{universe_name}_{world_name}_{df}_apcbkp.zip"
-        store_location = path.join(auto_backup_folder, zip_name)
+        backup_name = f"{universe_name}_{world_name}_{df}_apcbkp{backup_extension()}"
+        store_location = path.join(auto_backup_folder, backup_name)
     else:
-        zip_name = f"{universe_name}_{world_name}_{df}.zip"
-        store_location = path.join(backup_folder, zip_name)
+        backup_name = f"{universe_name}_{world_name}_{df}{backup_extension()}"
+        store_location = path.join(backup_folder, backup_name)
     
-    success = zip_method(world_folder, store_location, auto)
+    if backup_mode != 'zip':
+        success = store_world(world_folder, store_location)
+    else:
+        success = zip_method(world_folder, store_location, auto)
 
     if running:
         run_cmd('save-on')
@@ -265,4 +366,14 @@ def make_backup(run_cmd, save_event, auto=False):
         pyprint('An error happened during backup creation!', 3)
     backup_lock.release() 
 
-module = PCMod(__name__, description, patterns, callback, close, usage)
\ No newline at end of file
+def get_state():
+    return schedule
+
+def set_state(state, server_config, run_cmd, event_bus):
+    set_environment(server_config)
+    tm, amount = state
+    start_schedule(tm, amount, run_cmd, event_bus)
+    pyprint('Kept the backup schedule of every %s (max: %s backup%s).' % (pretty_time(tm), amount, 's' if amount > 1 else ''))
+
+# Backups are guarded by backup_lock, so other subcommands still work while a backup is running.
+module = PCMod(__name__, description, patterns, callback, close, usage, max_concurrency=4, state_callback=get_state, restore_callback=set_state)
\ No newline at end of file
@@ -3,8 +3,6 @@ import pycraft_utils as pu
 import re
 
 from pycraft_module import PCMod
-from threading import Thread
-from threading import Event
 from threading import Lock
 # from winsound import Beep
 
@@ -20,13 +18,9 @@ pattern_lock = Lock()
 def get_module():
     return module
 
-join_kill_event = Event()
-leave_kill_event = Event()
-chat_kill_event = Event()
-
-join_thread = None
-leave_thread = None
-chat_thread = None
+join_subscription = None
+leave_subscription = None
+chat_subscription = None
 
 def usage(subcmd=[]):
     return """Usage:   notify <SUBCOMMANDS>
@@ -47,45 +41,38 @@ def choice(v, t, f):
 def ed(v):
     return choice(v, 'enabled', 'disabled')
 
-def event_callback(et, k):
-    while not k.is_set():
-        if et.event.wait(1):
+def event_callback(record):
+    print('\u0007', end='', flush=True)
+    # Beep(750, 100)
+    # Beep(1000, 100)
+
+def chat_event_callback(record):
+    c = record.body
+    pattern_lock.acquire()
+    for p in chat_patterns:
+        if p.match(c):
             print('\u0007', end='', flush=True)
             # Beep(750, 100)
             # Beep(1000, 100)
+    pattern_lock.release()
 
-def chat_event_callback(et, k):
-    while not k.is_set():
-        if et.event.wait(1):
-            c = et.match.group(2)
-            pattern_lock.acquire()
-            for p in chat_patterns:
-                if p.match(c):
-                    print('\u0007', end='', flush=True)
-                    # Beep(750, 100)
-                    # Beep(1000, 100)
-            pattern_lock.release()
-
-def update_event(value, ov, t, e, k):
+def update_event(value, ov, s, event_bus, name):
     if value is None: rt = not ov
     elif value == 'on': rt = True
     elif value == 'off': rt = False
     else:
         pyprint("Did not recognize %s as 'on' or 'off'." % value)
-        return None
-
-    if t is None and rt:
-        t = Thread(target=event_callback, args=(e, k))
-        t.start()
-    elif not rt:
-        k.set()
-        t.join()
-        t = None
-        k.clear()
-    return rt, t
-
-def command_parser(cmd, server_config, run_cmd, event_triggers):
-    global join_thread, leave_thread, chat_thread
+        return None, s
+
+    if s is None and rt:
+        s = event_bus.subscribe(name, event_callback)
+    elif s is not None and not rt:
+        s.close()
+        s = None
+    return rt, s
+
+def command_parser(cmd, server_config, run_cmd, event_bus):
+    global join_subscription, leave_subscription, chat_subscription
     global join_notification, leave_notification, chat_patterns
 
     key, sub = pu.next_cmd(cmd)
@@ -96,19 +83,19 @@ def command_parser(cmd, server_config, run_cmd, event_triggers):
         key2, sub2 = pu.next_cmd(sub)
         if pu.max_cmd_len(sub2, 0, pyprint): return
 
-        rt, t = update_event(key2, join_notification, join_thread, event_triggers['join'], join_kill_event)
+        rt, s = update_event(key2, join_notification, join_subscription, event_bus, 'join')
         if rt is None: return
         join_notification = rt
-        join_thread = t
+        join_subscription = s
         pyprint("Join: %s" % ed(rt))
     elif key == "leave":
         key2, sub2 = pu.next_cmd(sub)
         if pu.max_cmd_len(sub2, 0, pyprint): return
         
-        rt, t = update_event(key2, leave_notification, leave_thread, event_triggers['leave'], leave_kill_event)
+        rt, s = update_event(key2, leave_notification, leave_subscription, event_bus, 'leave')
         if rt is None: return
         leave_notification = rt
-        leave_thread = t
+        leave_subscription = s
         pyprint("Leave: %s" % ed(rt))
     elif key == 'chat':
         key2, sub2 = pu.next_cmd(sub)
@@ -150,26 +137,41 @@ def command_parser(cmd, server_config, run_cmd, event_triggers):
                     pattern_lock.release()
                     return
 
-        if chat_thread is None and len(chat_patterns) > 0:
-            chat_thread = Thread(target=chat_event_callback, args=(event_triggers['any'], chat_kill_event))
-            chat_thread.start()
-        elif len(chat_patterns) == 0:
-            chat_kill_event.set()
-            chat_thread.join()
-            chat_thread = None
-            chat_kill_event.clear()
+        if chat_subscription is None and len(chat_patterns) > 0:
+            chat_subscription = event_bus.subscribe('any', chat_event_callback)
+        elif chat_subscription is not None and len(chat_patterns) == 0:
+            chat_subscription.close()
+            chat_subscription = None
         pattern_lock.release()
     else:
         pyprint(usage())
 
 def close():
-    ''' End all threads '''
-    join_kill_event.set()
-    leave_kill_event.set()
-    chat_kill_event.set()
-    if join_thread is not None: join_thread.join()
-    if leave_thread is not None: leave_thread.join()
-    if chat_thread is not None: chat_thread.join()
-
-
-module = PCMod(__name__, description, patterns, command_parser, close, usage)
\ No newline at end of file
+    ''' End all subscriptions '''
+    global join_subscription, leave_subscription, chat_subscription
+    global join_notification, leave_notification
+    for s in (join_subscription, leave_subscription, chat_subscription):
+        if s is not None: s.close()
+    join_subscription = leave_subscription = chat_subscription = None
+    join_notification = leave_notification = False
+
+def get_state():
+    ''' Hand the notifications over to the reloaded module. '''
+    return {'join': join_notification, 'leave': leave_notification, 'chat': [p.pattern for p in chat_patterns]}
+
+def set_state(state, server_config, run_cmd, event_bus):
+    global join_subscription, leave_subscription, chat_subscription
+    global join_notification, leave_notification, chat_patterns
+    if state['join']:
+        join_notification = True
+        join_subscription = event_bus.subscribe('join', event_callback)
+    if state['leave']:
+        leave_notification = True
+        leave_subscription = event_bus.subscribe('leave', event_callback)
+    with pattern_lock:
+        chat_patterns = [re.compile(p) for p in state['chat']]
+        if len(chat_patterns) > 0:
+            chat_subscription = event_bus.subscribe('any', chat_event_callback)
+
+
+module = PCMod(__name__, description, patterns, command_parser, close, usage, state_callback=get_state, restore_callback=set_state)
\ No newline at end of file
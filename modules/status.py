@@ -3,7 +3,6 @@ import pycraft_utils as pu
 import re
 
 from pycraft_module import PCMod
-from mcstatus import MinecraftServer
 
 description = "Get server status from current server."
 patterns = ['status']
@@ -22,7 +21,7 @@ With subcommand:
 def pyprint(string, loglevel=1):
     get_module().pyprint(string, loglevel)
 
-def callback(cmd, server_config, run_cmd, event_triggers):
+def callback(cmd, server_config, run_cmd, event_bus):
     h, t = pu.next_cmd(cmd)
     port = int(server_config['port'])
     if len(t) > 0:
@@ -37,6 +36,7 @@ def format_strip(string):
     return re.sub(re.compile('§.'), '', string)
 
 def server_status(port, variant):
+    from mcstatus import MinecraftServer # Slow to import, only when needed.
     if variant is None:
         variant = 'status'
     try:
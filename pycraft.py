@@ -1,31 +1,35 @@
 ### pycraft_server.py
 ## Script provided as-is by AgentM
 ## Handles a minecraft server.
+import time
+startup_time = time.perf_counter() # Before the other imports, so --profile-startup includes them.
+
 import pycraft_utils as pu
 
 import modified_utf8 as utf8m
 import pycraft_module
+import pycraft_events
+import pycraft_console
+import pycraft_jobs
+import pycraft_scheduler
 import subprocess
 import importlib
+import importlib.util
+import hashlib
 import argparse
-import tempfile
-import shutil
 import locale
 import glob
 import json
-import time
 import sys
-import zipfile
 import os
 import re
 
-from mcstatus import MinecraftServer
-from jprops import Properties
 from threading import Thread
 from threading import Event
-from threading import Lock
-from threading import Condition
+from collections import deque
+from concurrent.futures import CancelledError
 from queue import Queue
+from queue import Full
 from os import path
 
 # Make sure our working directory is the location of the pycraft_server.py file.
@@ -37,6 +41,8 @@ DEBUG = False
 if DEBUG:
 	pycraft_module.log_flag |= 0b1111
 
+imports_time = time.perf_counter()
+
 #GLOBALS
 # Version history: 1.0 is unsafe due to log4j error. Use 1.1+
 pycraft_server_version = '1.1'
@@ -46,61 +52,59 @@ servers_location = 'servers'
 backups_location = 'backups'
 modules_location = 'modules'
 resources_location = 'resources'
+cache_location = '.pycraft' # Inside every server folder, holds files made by PyCraft (e.g. the launch plan, the startup history).
 sys.path.insert(1, modules_location) # Tell python to look in the modules folder when relaoding imports.
 
-encoding_inbound = None
-event_triggers = None
-server_config = None
-server_version = None
-server_properties = None
-queue_lock = Lock()
-read_flag = False
-running = False
-command_providers = []
-raw_imports = []
-read_condition = Condition()
-
-date_pattern = '\\d{4}-\\d{2}-\\d{2}'
-time_pattern = '\\d{1,2}:\\d{1,2}:\\d{1,2}'
-log_level_pattern = '\\[[a-zA-Z\\s]*?(?:|#\\d+)\\/[A-Z].*?\\]'
-
-base_pattern = f'(^\\[{time_pattern}\\] {log_level_pattern}:) (%s)'
-name_pattern = '[a-zA-Z0-9_]+?' # Use this when you don't use pre-/suffixes (safer)
-ps_name_pattern = '[^<*].*' # Can be anything because of pre-/suffixes BUT disallows < and > usage. (more lenient, less safe)
-
-float_pattern = "-?[0-9]+\\.[0-9]+"
-uuid_pattern = "[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
-startup_time_pattern = '\\([0-9.]+[nmhs]{1,2}\\)'
-
-signature_done = re.compile(base_pattern % f'Done {startup_time_pattern}! For help, type "help"')
-signature_save = re.compile(base_pattern % 'Saved the game')
-signature_stop = re.compile(base_pattern % 'Stopping server')
-signature_join = re.compile(base_pattern % f'UUID of player {name_pattern} is {uuid_pattern}$')
-signature_leave = re.compile(base_pattern % f'{name_pattern} lost connection: .*$')
-signature_chat = re.compile(base_pattern % '<[^>]*> .*')
-signature_server_chat = re.compile(base_pattern % '[Server] .*') # Not safe. May also trigger on entities or commandblocks named 'Server' performing the /say command.
-signature_emote = re.compile(base_pattern % '\\* [^ ]*? .*')
-signature_any = re.compile(base_pattern % '.*')
-
-legacy_base_pattern = f'(^{date_pattern} {time_pattern} \\[INFO\\]) (%s)'
-legacy_signature_done = re.compile(legacy_base_pattern % f'Done {startup_time_pattern}! For help, type "help" or "\\?"$')
-legacy_signature_save = re.compile(legacy_base_pattern % 'CONSOLE: Save complete\\.$')
-legacy_signature_stop = re.compile(legacy_base_pattern % 'Stopping server$')
-legacy_signature_join = re.compile(legacy_base_pattern % f'{name_pattern} \\[[0-9a-zA-Z_./:-]+\\] logged in with entity id \\d{{1,10}} at \\({float_pattern}, {float_pattern}, {float_pattern}\\)$')
-legacy_signature_leave = re.compile(legacy_base_pattern % f'{name_pattern} lost connection: .*$')
-legacy_signature_chat = re.compile(legacy_base_pattern % '<[^>]*> .*')
-legacy_signature_server_chat = re.compile(legacy_base_pattern % '[CONSOLE] .*') # Triggers on any output from the console.
-legacy_signature_emote = re.compile(legacy_base_pattern % '\\* [^ ]*? .*')
-legacy_signature_any = re.compile(legacy_base_pattern % '.*')
+input_queue_size = 64 # Max amount of console lines waiting to be handled per server, the reader blocks when exceeded.
+servers = {} # name -> ServerContext of every server run by this process.
+selected_server = None # Name of the server receiving console input that isn't routed with @.
+restart_backoff = 1 # Seconds to wait before restarting a crashed server, doubled for every recent crash.
+restart_backoff_max = 30
+crash_loop_limit = 5 # Max amount of crashes within crash_loop_window seconds, the server isn't restarted after that.
+crash_loop_window = 600
+profile_startup = False # Print where the startup time goes (--profile-startup).
+cds_location = 'cds' # Inside the cache folder of a server, holds the class data sharing archive of the JVM.
+startup_history_file = 'startup_history.jsonl' # Inside the cache folder of a server, one line per launch that got done.
+startup_regression = 1.2 # Flag a version when its median startup is this many times slower than the version before it,
+startup_regression_min = 0.5 # and at least this many seconds slower.
 
 signature_encoding = re.compile("-Dfile\\.encoding=(.*)")
-
-class EventTrigger:
-	def __init__(self, signature):
-		self.event = Event()
-		self.signature = signature
-		self.data = None
-		self.match = None
+signature_gc = re.compile("-XX:[+-]Use[A-Za-z0-9]*GC$")
+signature_jvm_option = re.compile("-(?:XX:[+-]?|D)([^=]+)")
+signature_heap = re.compile("-X(?:mx|ms|mn|ss)")
+
+# Named sets of JVM arguments, servers pick them with jvm-profile. More can be added with jvm-profiles in the config.
+jvm_profiles = {
+	# Short, predictable GC pauses for a server with players (G1 tuned for the allocation pattern of minecraft).
+	'g1-low-pause': [
+		'-XX:+UseG1GC',
+		'-XX:+ParallelRefProcEnabled',
+		'-XX:MaxGCPauseMillis=200',
+		'-XX:+UnlockExperimentalVMOptions',
+		'-XX:+DisableExplicitGC',
+		'-XX:+AlwaysPreTouch',
+		'-XX:G1NewSizePercent=30',
+		'-XX:G1MaxNewSizePercent=40',
+		'-XX:G1HeapRegionSize=8M',
+		'-XX:G1ReservePercent=20',
+		'-XX:G1MixedGCCountTarget=4',
+		'-XX:InitiatingHeapOccupancyPercent=15',
+		'-XX:SurvivorRatio=32',
+		'-XX:+PerfDisableSharedMem',
+		'-XX:MaxTenuringThreshold=1',
+	],
+	# Little memory and CPU overhead, for small (test) servers with a heap of a few GB at most.
+	'small-heap': [
+		'-XX:+UseSerialGC',
+		'-XX:MinHeapFreeRatio=10',
+		'-XX:MaxHeapFreeRatio=30',
+		'-XX:+DisableExplicitGC',
+	],
+}
+memory_budget = 0.5 # Default fraction of the host memory shared by the heaps of the servers run together.
+min_heap = 512 # MB
+max_heap = 31744 # MB, a larger heap disables compressed pointers.
+cohosted_servers = [] # Names of the servers run by this process, to share the host memory between.
 
 safety = ""
 severities = ['DEBUG', 'INFO', 'WARN', 'ERROR']
@@ -111,12 +115,15 @@ def arguments():
 	parser = argparse.ArgumentParser(description="Run a minecraft server with backups, shut-down hooks and possibly scripts.", epilog="Priority Order: Arguments, config.json, server.properties, DEFAULT")
 
 	# Required
-	parser.add_argument(dest="server_name", help="Starts the server with the specified name, matching case. If not specified, an interactive console allows you to select one.", nargs='?', default=None)
+	parser.add_argument(dest="server_names", help="Starts the servers with the specified names, matching case. If not specified, an interactive console allows you to select one.", nargs='*', default=[])
 	
 	# Optional
 	parser.add_argument("-j", "--jvm-args", default=[], nargs="+", dest="jvm_arguments", help="Run the server with more RAM or other jvm arguments (don't include the leading dashes).")
 	parser.add_argument("-u", "--universe", default=None, dest="universe", help='Select a folder as the save location of world folders for the server. (see Priority Order)')
 	parser.add_argument("-w", "--world", default=None, dest="world", help="Select a folder as the world folder to load for the server. (see Priority Order)")
+	parser.add_argument("--all", action="store_true", dest="all", help="Starts every server in the server-list.")
+	parser.add_argument("--profile-startup", action="store_true", dest="profile_startup", help="Print how long each phase of the startup took, up to the server being done.")
+	parser.add_argument("--asyncio", action="store_true", dest="use_asyncio", help="Run the server console on an asyncio event loop instead of threads.")
 	return parser.parse_args()
 
 def read_config():
@@ -134,44 +141,70 @@ def find_server_config(server_name, dict_list):
 	raise Exception('[Config] Configuration for %s was not found!' % server_name)
 
 def get_server_properties(server_jar_location):
+	from jprops import Properties
 	p = Properties()
 	with open(path.join(server_jar_location, 'server.properties'), 'r') as f:
 		p.load(f)
 	return p
 
-def run_server_get_defaults(server_jar_location, default_java_path):
-	pyprint("No server.properties file found! Running server in quarantined location to obtain defaults...")
-	
+def run_server_get_defaults(server_jar_location, default_java_path, server_version):
+	'''
+	Creates the default server.properties and eula.txt in server_jar_location.
+	They are taken from the defaults cache of the version if possible, else a server is run in a quarantined location
+	to generate them (once per version).
+	'''
+	import shutil
+	names = ["eula.txt", "server.properties"]
+	cache_dir = None
+	if server_version['id'] != "Unknown":
+		cache_dir = path.join(resources_location, 'defaults', server_version['id'])
+
+	if cache_dir is None or not all(path.isfile(path.join(cache_dir, name)) for name in names):
+		pyprint("No server.properties file found! Running server in quarantined location to obtain defaults...")
+		generate_server_defaults(server_jar_location, default_java_path, cache_dir or server_jar_location)
+		if cache_dir is None:
+			return
+	else:
+		pyprint(f"No server.properties file found! Using the defaults of {server_version['id']}...")
+
+	# Copy the required files.
+	for name in names:
+		dest = path.join(server_jar_location, name)
+		if not path.exists(dest):
+			shutil.copy(path.join(cache_dir, name), dest)
+
+def generate_server_defaults(server_jar_location, default_java_path, destination):
+	'''
+	Runs the server in a quarantined location, and copies the generated server.properties and eula.txt to destination
+	(if not there yet).
+	'''
+	import tempfile
+	import shutil
 	orig_jar_path = path.join(server_jar_location, 'server.jar')
 	with tempfile.TemporaryDirectory(dir=server_jar_location, ignore_cleanup_errors=True) as temp_dir_name:
 		new_jar_path = path.join(temp_dir_name, 'server.jar')
 
 		try:
-			shutil.copy(orig_jar_path, new_jar_path)
+			# A hard link is instant, the temp folder is on the same drive. Copy if links aren't supported.
+			try:
+				os.link(orig_jar_path, new_jar_path)
+			except OSError:
+				shutil.copy(orig_jar_path, new_jar_path)
 
 			# Create eula file
 			with open(path.join(temp_dir_name, "eula.txt"), 'w+') as f:
 				f.write("eula=true\n")
 
 			# Run temp server
-			wd = os.getcwd()
-			os.chdir(temp_dir_name)
 			pyprint(" =========== Running Server in Quarantined Location to obtain default configuration =========== ")
-			subprocess.run([default_java_path] + ["-jar", "server.jar"], input="stop", encoding="UTF-8")
+			subprocess.run([default_java_path] + ["-jar", "server.jar"], input="stop", encoding="UTF-8", cwd=temp_dir_name)
 			pyprint(" ========================================== Finished ========================================== ")
-			os.chdir(wd)
-
-			name_eula = "eula.txt"
-			name_server_properties = "server.properties"
 
-			# Copy the required files.
-			eula_dest = path.join(server_jar_location, name_eula)
-			if not path.exists(eula_dest):
-				shutil.copy(path.join(temp_dir_name, name_eula), eula_dest)
-
-			prop_dest = path.join(server_jar_location, name_server_properties)
-			if not path.exists(prop_dest):
-				shutil.copy(path.join(temp_dir_name, name_server_properties), prop_dest)
+			os.makedirs(destination, exist_ok=True)
+			for name in ["eula.txt", "server.properties"]:
+				dest = path.join(destination, name)
+				if not path.exists(dest):
+					shutil.copy(path.join(temp_dir_name, name), dest)
 		except:
 			# cleanup temp dir on error
 			shutil.rmtree(temp_dir_name)
@@ -199,14 +232,57 @@ def expect_type(name, key, ty):
 	if not isinstance(key, ty):
 		raise Exception(f"[Config] Type of {name} must be {ty}, but was: {key} ({type(key)})")
 
-def configure(key, value):
+def configure(server_config, key, value):
 	'''
 	Ensures key-value is in the server config, then returns the value.
 	'''
-	global server_config
 	server_config[key] = value
 	return value
 
+def jvm_option(arg):
+	'''
+	Returns the option an argument sets, so a later argument for the same option can replace it.
+	'''
+	if signature_gc.match(arg):
+		return 'GC' # Only one garbage collector can be used.
+	if signature_heap.match(arg):
+		return arg[:4]
+	m = signature_jvm_option.match(arg)
+	if m:
+		return arg[:2] + m.group(1)
+	return arg
+
+def merge_jvm_args(*arg_lists):
+	'''
+	Returns the arguments of all lists, where an option set by a later list replaces the one set by an earlier list.
+	'''
+	merged = {}
+	for args in arg_lists:
+		for arg in args:
+			option = jvm_option(arg)
+			merged.pop(option, None) # Keep the order in which the options were last set.
+			merged[option] = arg
+	return list(merged.values())
+
+def auto_heap(server_name, config):
+	'''
+	Returns the heap size in MB of the server: its heap-weight share of the memory-budget of the host memory, divided
+	between the cohosted_servers. Returns None if the host memory is unknown.
+	'''
+	total = pu.total_memory()
+	if total is None:
+		return None
+	budget = try_get([config.get('memory-budget')], default=memory_budget)
+	expect_type('memory-budget', budget, (int, float))
+	names = cohosted_servers if server_name in cohosted_servers else [server_name]
+	weights = {}
+	for name in names:
+		weight = try_get([find_server_config(name, config['server-list']).get('heap-weight')], default=1)
+		expect_type('heap-weight', weight, (int, float))
+		weights[name] = weight
+	heap = int(total * budget * weights[server_name] / sum(weights.values())) >> 20
+	return max(min_heap, min(max_heap, heap))
+
 # WARNING. THIS PATCH ONLY WORKS ON VANILLA JARS
 def log4j_patch(server_version, server_jar_location, jvm_arguments):
 	global safety
@@ -309,47 +385,127 @@ def log4j_patch(server_version, server_jar_location, jvm_arguments):
 				pyprint("Patching log4j...")
 				shutil.copy(cache_path, xml_destination)
 
-def init_event_triggers(use_legacy):
-	global event_triggers
-
-	# Initialize event triggers based on version
-	event_triggers = {
-		# Triggers when the server is done loading and is ready to receive commands.
-		'done': EventTrigger(legacy_signature_done if use_legacy else signature_done),
-		# Triggers when the server is saved using save-all.
-		'save': EventTrigger(legacy_signature_save if use_legacy else signature_save),
-		# Triggers when the server is stopped. (for shutdown hooks only, spawn a thread waiting for this event.)
-		'stop': EventTrigger(legacy_signature_stop if use_legacy else signature_stop),
-		# Triggers when a player joins the server.
-		'join': EventTrigger(legacy_signature_join if use_legacy else signature_join),
-		# Triggers when a player leaves the server.
-		'leave': EventTrigger(legacy_signature_leave if use_legacy else signature_leave),
-		# Triggers on any chat message (starting with <NAME>)
-		'chat': EventTrigger(legacy_signature_chat if use_legacy else signature_chat),
-		# Triggers on any chat message sent by the SERVER ONLY. (or a player named Server, be careful, don't give them '/say' access)
-		'server-chat': EventTrigger(legacy_signature_server_chat if use_legacy else signature_server_chat),
-		# Triggers on all emotes (lines starting with *).
-		'emote': EventTrigger(legacy_signature_emote if use_legacy else signature_emote),
-		# Triggers on anything, useful for partially regexxing.
-		'any': EventTrigger(legacy_signature_any if use_legacy else signature_any),
-	}
+class ServerContext:
+	'''
+	Everything belonging to a single server: its configuration, modules, events and console.
+	Every server run by this process has its own, so servers never share module instances or state.
+	'''
 
-def obtain_launch_code(config, args):
-	global server_config, server_properties, server_jar, server_version, encoding_inbound
+	def __init__(self, name, prefix=''):
+		'''
+		name: The name of the server (folder).
+		prefix: Printed in front of every line of this server, to tell servers apart when running more than one.
+		'''
+		self.name = name
+		self.prefix = prefix
+		self.server_config = None
+		self.server_version = None
+		self.server_properties = None
+		self.encoding_inbound = None
+		self.launch_code = None
+		self.cds_archive = None # The class data sharing archive used or created by the current launch.
+		self.cds_state = 'off' # 'on' when using the archive, 'dump' when creating it, else 'off'.
+		self.event_dispatcher = None
+		self.event_bus = None
+		self.console_writer = None
+		self.event_loop = None # The event loop of the asyncio core, None when using threads.
+		self.command_jobs = pycraft_jobs.JobRunner()
+		self.scheduler = pycraft_scheduler.Scheduler() # Timed jobs of the modules.
+		self.command_registry = pycraft_module.CommandRegistry(builtin_commands)
+		self.command_providers = []
+		self.raw_imports = {} # module name -> imported python module
+		self.module_fingerprints = {} # module name -> (mtime, size, sha256) of its file when it was loaded
+		self.input_queue = Queue(maxsize=input_queue_size) # Lines typed for this server.
+		self.running = False
+		self.stop_seen = False # The server logged that it is stopping (so it didn't crash).
+		self.stop_requested = Event() # Set by the stop command, also interrupts waiting for a restart.
+		self.crashes = deque() # Times of the recent crashes, for the crash-loop breaker.
+		self.launch_time = startup_time # Start of the current launch (PyCraft starting, or the restart).
+		self.timeline = [] # (phase, time.perf_counter()) of the current launch, until the server is done.
+		self.module_times = {} # module name -> seconds it took to load (including its imports)
+		self.restarts = 0 # Amount of times the server was restarted after a crash.
+		self.done = False # The server is done starting (since the last launch).
+
+	def mark(self, phase):
+		'''
+		Marks the end of a startup phase.
+		'''
+		self.timeline.append((phase, time.perf_counter()))
+
+	def relaunch(self):
+		'''
+		Starts a new timeline, before restarting the server.
+		'''
+		self.launch_time = time.perf_counter()
+		self.timeline = []
+		self.restarts += 1
+		self.done = False
+
+	def pyprint(self, string, loglevel=1):
+		print(f"{self.prefix}[{safety}PyCraft/%s] %s" % (severities[loglevel], string))
+
+	def write(self, msg, wait=False):
+		'''
+		msg: The message as a utf-8 encoded string.
+		wait: Return a Future which is done when the message was written, instead of nothing (fire-and-forget).
+		The message is written by the console writer thread, so this never blocks.
+		Raises an Exception while the server is down (e.g. waiting for a restart).
+		'''
+		if self.console_writer is None:
+			raise Exception('The server is not running')
+		if wait:
+			return self.console_writer.submit(msg)
+		self.console_writer.write(msg)
+
+	def writeline(self, msg, wait=False):
+		return self.write(msg + "\n", wait)
+
+	def put_input(self, line):
+		'''
+		Queues a line typed for this server. Blocks while the queue is full, so a pasted batch is throttled by the consumer.
+		Returns False if the server isn't running.
+		'''
+		if self.event_loop is None:
+			while self.running:
+				try:
+					self.input_queue.put(line, timeout=0.5)
+					return True
+				except Full:
+					pass
+			return False
+		if not self.running:
+			return False
+		import asyncio
+		try:
+			asyncio.run_coroutine_threadsafe(self.input_queue.put(line), self.event_loop).result()
+			return True
+		except (Exception, CancelledError):
+			return False # The event loop has stopped.
+
+def init_events(ctx, use_legacy):
+	# Initialize event recognition based on version
+	ctx.event_dispatcher = pycraft_events.EventDispatcher(use_legacy)
+	ctx.event_bus = pycraft_events.EventBus()
 
-	server_name = args.server_name
-	server_config = find_server_config(server_name, config['server-list'])
+def obtain_launch_code(ctx, config, args):
+	'''
+	Resolves the configuration of the server and stores the command launching it in ctx.launch_code.
+	'''
+	server_name = ctx.name
+	server_config = ctx.server_config = find_server_config(server_name, config['server-list'])
+	server_version = None
 	server_jar_location = path.join(servers_location, server_name)
 	server_jar = path.join(server_jar_location, 'server.jar')
 	if not path.exists(server_jar):
 		raise Exception(f"[Config] Could not find the server located at: {server_jar}")
 
-	version = configure('version', try_get([server_config.get('version')], default='custom'))
+	version = configure(server_config, 'version', try_get([server_config.get('version')], default='custom'))
 	expect_type('version', version, str)
 
-	init_event_triggers(version == "legacy")
+	init_events(ctx, version == "legacy")
 
 	if (version != "legacy"):
+		import zipfile
 		with zipfile.ZipFile(server_jar) as z:
 			try:
 				with z.open("version.json") as f:
@@ -366,6 +522,7 @@ def obtain_launch_code(config, args):
 
 	if not 'java_component' in server_version:
 		server_version['java_component'] = "jre-legacy"
+	ctx.server_version = server_version
 
 	java_component = server_version['java_component']
 	default_java_path = f"C:\\Program Files (x86)\\Minecraft Launcher\\runtime\\{java_component}\\windows-x64\\{java_component}\\bin\\java.exe"
@@ -380,11 +537,30 @@ def obtain_launch_code(config, args):
 	jvm_arguments = try_get([["-" + a for a in args.jvm_arguments], config.get('jvm-args')], none_values=[None, []], default=[])
 	expect_type('jvm-args', jvm_arguments, list)
 
+	# JVM profiles, the jvm-args override their options.
+	profiles = dict(jvm_profiles)
+	profiles.update(config.get('jvm-profiles', {}))
+	profile_names = configure(server_config, 'jvm-profile', try_get([server_config.get('jvm-profile'), config.get('jvm-profile')], default=[]))
+	if isinstance(profile_names, str):
+		profile_names = [profile_names]
+	expect_type('jvm-profile', profile_names, list)
+	for name in profile_names:
+		if name not in profiles:
+			raise Exception(f"[Config] Unknown jvm-profile: {name} (known: {', '.join(profiles)})")
+	jvm_arguments = merge_jvm_args(*[profiles[name] for name in profile_names], jvm_arguments)
+
+	# Heap size, if not given by the jvm-args or profiles.
+	if not any(arg.startswith('-Xmx') for arg in jvm_arguments):
+		heap = auto_heap(server_name, config)
+		if heap is not None:
+			pyprint(f'Heap size: {heap}M', 0)
+			jvm_arguments = merge_jvm_args([f'-Xms{heap}M', f'-Xmx{heap}M'], jvm_arguments)
+
 	# Encoding patch
 	for arg in jvm_arguments:
 		m = signature_encoding.match(arg)
 		if m:
-			encoding_inbound = m.group(1)
+			ctx.encoding_inbound = m.group(1)
 			break
 
 	# Log4j security patch
@@ -395,23 +571,31 @@ def obtain_launch_code(config, args):
 		server_properties = get_server_properties(server_jar_location)
 	except FileNotFoundError:
 		# Attempt again after generating defaults
-		run_server_get_defaults(server_jar_location, default_java_path)
+		run_server_get_defaults(server_jar_location, default_java_path, server_version)
 		server_properties = get_server_properties(server_jar_location)
+	ctx.server_properties = server_properties
 
 	# Configure
-	universe = configure('universe', try_get([args.universe, server_config.get('universe')], default='worlds'))
+	universe = configure(server_config, 'universe', try_get([args.universe, server_config.get('universe')], default='worlds'))
 	expect_type('universe', universe, str)
-	world = configure('world', try_get([args.world, server_config.get('world'), server_properties.get('level-name')], default='world'))
+	world = configure(server_config, 'world', try_get([args.world, server_config.get('world'), server_properties.get('level-name')], default='world'))
 	expect_type('world', world, str)
+	auto_restart = configure(server_config, 'auto-restart', try_get([server_config.get('auto-restart')], default=False))
+	expect_type('auto-restart', auto_restart, bool)
+	cds = configure(server_config, 'class-data-sharing', try_get([server_config.get('class-data-sharing')], default=False))
+	expect_type('class-data-sharing', cds, bool)
+	if cds and java_executable == default_java_path and java_component == 'jre-legacy':
+		pyprint('Class data sharing archives need Java 13 or newer, class-data-sharing is ignored.', 2)
+		server_config['class-data-sharing'] = False
 	nogui = config.get('hide-gui', True)
 	expect_type('hide-gui', nogui, bool)
 	forceupgrade = config.get('upgrade-all-chunks-on-version-mismatch', False)
 	expect_type('upgrade-all-chunks-on-version-mismatch', forceupgrade, bool)
-	port = configure('port', try_get([server_config.get('port'), int(server_properties.get('server-port'))], default=25565))
+	port = configure(server_config, 'port', try_get([server_config.get('port'), int(server_properties.get('server-port'))], default=25565))
 	expect_type('port', port, int)
 
 	pyprint(int(try_get([server_properties.get('query.port')], default=25565)))
-	qport = configure('query-port', int(try_get([server_properties.get('query.port')], default=25565)))
+	qport = configure(server_config, 'query-port', int(try_get([server_properties.get('query.port')], default=25565)))
 	
 	expect_type('query-port', qport, int)
 	module_data = config.get('module-data', {})
@@ -421,140 +605,514 @@ def obtain_launch_code(config, args):
 	server_config['module-data'] = module_data
 
 	# Convenience locations (stored in RAM only)
-	configure('server-root', server_jar_location)
+	configure(server_config, 'server-root', server_jar_location)
 
 	# Depends on universe set.
 	if universe != "":
-		configure('world-root', path.join(path.join(server_jar_location, universe), world))
+		configure(server_config, 'world-root', path.join(path.join(server_jar_location, universe), world))
 	else:
-		configure('world-root', path.join(server_jar_location, world))
+		configure(server_config, 'world-root', path.join(server_jar_location, world))
 
 	server_argument_list = server_args(universe, world, nogui, forceupgrade, port)
-	return [java_executable] + jvm_arguments + ['-jar', 'server.jar'] + server_argument_list
+	ctx.launch_code = [java_executable] + jvm_arguments + ['-jar', 'server.jar'] + server_argument_list
+	return ctx.launch_code
 
-def launch_server(name, launch_code):
-	wd = os.getcwd()
-	os.chdir('%s/%s' % (servers_location, name))
-	p = subprocess.Popen(launch_code, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT)
-	os.chdir(wd)
-	return p
+def launch_plan_key(server_root, config_hash, old_key=None):
+	'''
+	Returns the key of the launch plan: fingerprints of the server.jar and server.properties, and the hash of the config.
+	Files are only hashed again if their mtime or size differ from old_key.
+	'''
+	old_key = old_key or {}
+	jar = old_key.get('jar')
+	properties = old_key.get('properties')
+	return {
+		'jar': list(fingerprint(path.join(server_root, 'server.jar'), None if jar is None else tuple(jar))),
+		'properties': list(fingerprint(path.join(server_root, 'server.properties'), None if properties is None else tuple(properties))),
+		'config': config_hash,
+	}
 
-def add_input(input_queue):
-	global read_flag
-	buff = []
-	while running:
-		c = sys.stdin.read(1)
-		buff.append(c)
-		if c == '\n':
-			queue_lock.acquire()
-			for i in buff:
-				input_queue.put(i)
-			buff = []
-			read_flag = True
-			queue_lock.release()
-			with read_condition:
-				read_condition.notify()
-
-def list_modules():
-	return ', '.join([cp.name for cp in command_providers])
-
-def import_tool():
-	global command_providers, raw_imports
-
-	for cp in command_providers:
-		cp.close() # Kill any threads first.
+def launch_config_hash(server_config, config, args):
+	'''
+	Returns a hash of everything in the config and arguments that obtain_launch_code depends on.
+	'''
+	global_config = {k: config.get(k) for k in ('java-executable', 'jvm-args', 'jvm-profile', 'jvm-profiles', 'memory-budget', 'hide-gui', 'upgrade-all-chunks-on-version-mismatch', 'module-data')}
+	# The automatic heap size depends on the host memory and the servers run together.
+	heap_weights = [(name, find_server_config(name, config['server-list']).get('heap-weight')) for name in cohosted_servers]
+	arguments = [args.jvm_arguments, args.universe, args.world, pu.total_memory(), heap_weights]
+	config_str = json.dumps([pycraft_server_version, server_config, global_config, arguments], sort_keys=True)
+	return hashlib.sha256(config_str.encode('utf-8')).hexdigest()
 
-	importlib.invalidate_caches()
-	modules = glob.glob(path.join(modules_location, "*.py"))
-	imports = [path.basename(f)[:-3] for f in modules if path.isfile(f) and not f.endswith('__init__.py')]
+def same_launch_plan_key(a, b):
+	return a['jar'][2] == b['jar'][2] and a['properties'][2] == b['properties'][2] and a['config'] == b['config']
 
-	def import_or_reload(mod):
-		for ri in raw_imports:
-			if ri.__name__ == mod:
-				return importlib.reload(ri)
-		return importlib.import_module(mod)
+def obtain_cached_launch_code(ctx, config, args):
+	'''
+	Like obtain_launch_code, but reuses the launch plan stored in the server folder if the server.jar, server.properties
+	and config didn't change since it was made. This skips reading the jar, finding java and patching log4j.
+	'''
+	server_root = path.join(servers_location, ctx.name)
+	plan_file = path.join(server_root, cache_location, 'launch_plan.json')
+	ctx.server_config = find_server_config(ctx.name, config['server-list'])
+	config_hash = launch_config_hash(ctx.server_config, config, args)
 
-	raw_imports = [import_or_reload(i) for i in imports]
-	command_providers = [i.get_module() for i in raw_imports]
-	pyprint('Succesfully (re)loaded modules: %s' % list_modules())
+	plan = None
+	try:
+		with open(plan_file, 'r') as f:
+			plan = json.load(f)
+		key = launch_plan_key(server_root, config_hash, plan['key'])
+		required = [plan['launch-code'][0]] if path.isabs(plan['launch-code'][0]) else []
+		required += [path.join(server_root, f) for f in plan['files']]
+		if not same_launch_plan_key(key, plan['key']) or not all(path.exists(f) for f in required):
+			plan = None
+	except (OSError, ValueError, KeyError, IndexError):
+		plan = None
+
+	if plan is not None:
+		pyprint('Using the cached launch plan.', 0)
+		ctx.server_config.update(plan['server-config'])
+		ctx.server_version = plan['server-version']
+		ctx.server_properties = plan['server-properties']
+		ctx.encoding_inbound = plan['encoding']
+		ctx.launch_code = plan['launch-code']
+		init_events(ctx, ctx.server_config['version'] == "legacy")
+		if plan['key'] != key:
+			save_launch_plan(ctx, plan_file, key, plan['files']) # Touched, but not changed.
+		return ctx.launch_code
+
+	obtain_launch_code(ctx, config, args)
+	if safety == "INSECURE-":
+		return ctx.launch_code # The security question must be asked on every launch.
+	try:
+		key = launch_plan_key(server_root, config_hash)
+		files = [arg.split('=', 1)[1] for arg in ctx.launch_code if arg.startswith('-Dlog4j.configurationFile=')]
+		save_launch_plan(ctx, plan_file, key, files)
+	except OSError as e:
+		pyprint(f'Could not cache the launch plan {e}', 2)
+	return ctx.launch_code
+
+def save_launch_plan(ctx, plan_file, key, files):
+	'''
+	key: The launch_plan_key the plan was made for.
+	files: Files in the server folder the launch code depends on (they must still exist to use the plan).
+	'''
+	plan = {
+		'key': key,
+		'launch-code': ctx.launch_code,
+		'server-config': ctx.server_config,
+		'server-version': ctx.server_version,
+		'server-properties': dict(ctx.server_properties.getPropertyDict() if hasattr(ctx.server_properties, 'getPropertyDict') else ctx.server_properties),
+		'encoding': ctx.encoding_inbound,
+		'files': files,
+	}
+	os.makedirs(path.dirname(plan_file), exist_ok=True)
+	with open(plan_file + '.tmp', 'w') as f:
+		json.dump(plan, f, indent=1)
+	os.replace(plan_file + '.tmp', plan_file)
 
-def show_help():
+def class_data_sharing_args(ctx):
+	'''
+	Returns the JVM arguments to boot from the class data sharing archive of the server, or to create it when the server
+	exits if there is no archive for the current server.jar and java executable yet. Sets ctx.cds_archive and ctx.cds_state.
+	'''
+	ctx.cds_archive = None
+	ctx.cds_state = 'off'
+	if not ctx.server_config.get('class-data-sharing', False):
+		return []
+	import shutil
+	server_root = path.join(servers_location, ctx.name)
+	cds_dir = path.abspath(path.join(server_root, cache_location, cds_location)) # The JVM runs in the server folder.
+	info_file = path.join(cds_dir, 'archive.json')
+	archive = path.join(cds_dir, 'server.jsa')
+	try:
+		with open(info_file, 'r') as f:
+			info = json.load(f)
+	except (OSError, ValueError):
+		info = {}
+	try:
+		old_jar = info.get('jar')
+		java = path.abspath(shutil.which(ctx.launch_code[0]) or ctx.launch_code[0])
+		st = os.stat(java)
+		key = {
+			'jar': list(fingerprint(path.join(server_root, 'server.jar'), None if old_jar is None else tuple(old_jar))),
+			'java': [java, st.st_mtime_ns, st.st_size],
+		}
+		ctx.cds_archive = archive
+		if info == key and path.isfile(archive):
+			ctx.cds_state = 'on'
+			return [f'-XX:SharedArchiveFile={archive}']
+
+		# The JVM rejects an archive made by another jar or JVM, so it is made again.
+		if path.exists(archive):
+			os.remove(archive)
+		os.makedirs(cds_dir, exist_ok=True)
+		with open(info_file + '.tmp', 'w') as f:
+			json.dump(key, f)
+		os.replace(info_file + '.tmp', info_file)
+	except (OSError, ValueError) as e:
+		ctx.pyprint(f'Class data sharing is off for this launch {e}', 2)
+		ctx.cds_archive = None
+		return []
+	ctx.cds_state = 'dump'
+	ctx.pyprint('Creating the class data sharing archive when the server stops...', 0)
+	return [f'-XX:ArchiveClassesAtExit={archive}']
+
+def finish_class_data_sharing(ctx):
+	'''
+	Called when the server exited. Removes an archive the JVM didn't finish (e.g. after a crash), it is created by the
+	next launch instead.
+	'''
+	if ctx.cds_state != 'dump':
+		return
+	if ctx.stop_seen and path.isfile(ctx.cds_archive):
+		ctx.pyprint('Created the class data sharing archive, the next launch boots faster.')
+		return
+	try:
+		os.remove(ctx.cds_archive)
+	except OSError:
+		pass
+
+def launch_command(ctx):
+	'''
+	Returns the command launching the server: the launch code with the class data sharing arguments of this launch.
+	'''
+	return ctx.launch_code[:1] + class_data_sharing_args(ctx) + ctx.launch_code[1:]
+
+def launch_server(ctx):
+	# Unbuffered, stdout is read in large chunks by the LineReader.
+	return subprocess.Popen(launch_command(ctx), stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0, cwd=path.join(servers_location, ctx.name))
+
+def add_input():
+	'''
+	Reads whole lines from stdin and hands each of them to the server it is meant for, until no server is running.
+	'''
+	for line in iter(sys.stdin.readline, ''):
+		route_input(line)
+		if not any(ctx.running for ctx in servers.values()):
+			break
+
+def route_input(line):
+	'''
+	Lines go to the selected server, unless they start with @:
+	 - @: List the servers.
+	 - @<SERVER>: Select the server that receives the following lines.
+	 - @<SERVER> <COMMAND>: Run the command on that server only.
+	 - @all <COMMAND>: Run the command on all running servers.
+	'''
+	global selected_server
+
+	s = line.strip()
+	if not s.startswith('@'):
+		targets = [servers[selected_server]]
+	else:
+		target, _, cmd = s[1:].partition(' ')
+		cmd = cmd.strip()
+		if target == '':
+			pyprint('Servers: %s' % ', '.join('%s (%s%s)' % (ctx.name, 'running' if ctx.running else 'stopped', ', selected' if ctx.name == selected_server else '') for ctx in servers.values()))
+			return
+		if target == 'all':
+			targets = [ctx for ctx in servers.values() if ctx.running]
+		elif target in servers:
+			targets = [servers[target]]
+		else:
+			pyprint('Unknown server: %s' % target, 3)
+			return
+		if len(cmd) == 0:
+			if target == 'all':
+				pyprint('Specify a command to run on all servers.', 3)
+			else:
+				selected_server = target
+				pyprint('Commands now go to %s.' % target)
+			return
+		line = cmd + '\n'
+	for ctx in targets:
+		if not ctx.put_input(line):
+			ctx.pyprint('Server is not running, use @<SERVER> to select another.', 2)
+
+def list_modules(ctx):
+	return ', '.join([cp.name for cp in ctx.command_providers])
+
+def close_modules(ctx, timeout=10):
+	'''
+	Cancels waiting module commands, closes all modules and waits for their running commands.
+	'''
+	ctx.command_jobs.cancel()
+	for cp in ctx.command_providers:
+		cp.close() # Kill any threads first.
+	for job in ctx.command_jobs.wait(timeout=timeout):
+		ctx.pyprint('Command #%d "%s" is still running after closing %s!' % (job.id, job.command, job.module), 2)
+
+def fingerprint(file, old=None):
+	'''
+	Returns the (mtime, size, sha256) of the file. The file is only hashed if its mtime or size differ from old.
+	'''
+	st = os.stat(file)
+	if old is not None and old[:2] == (st.st_mtime_ns, st.st_size):
+		return old
+	with open(file, 'rb') as f:
+		return (st.st_mtime_ns, st.st_size, hashlib.sha256(f.read()).hexdigest())
+
+def load_module(mod, file):
+	'''
+	Returns a new instance of the module in file, separate from the instances loaded for other servers.
+	'''
+	spec = importlib.util.spec_from_file_location(mod, file)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+def unload_module(ctx, cp, timeout=10):
+	'''
+	Cancels waiting commands of the module, closes it and waits for its running commands.
+	Returns the state to hand over to a reloaded version.
+	'''
+	state = None
+	try:
+		state = cp.get_state()
+	except Exception as e:
+		ctx.pyprint('%s: Getting the state of %s, it starts fresh.' % (e, cp.name), 2)
+	ctx.command_jobs.cancel(cp.name)
+	cp.close()
+	ctx.scheduler.cancel_owner(cp.name)
+	for job in ctx.command_jobs.wait(cp.name, timeout):
+		ctx.pyprint('Command #%d "%s" is still running after closing %s!' % (job.id, job.command, job.module), 2)
+	ctx.command_registry.unregister(cp)
+	return state
+
+def import_tool(ctx, full=False):
+	'''
+	Loads the modules in the modules folder. Only modules whose file changed are closed and reloaded, new ones are
+	imported and removed ones are closed. Use full to reload all modules.
+	'''
+	importlib.invalidate_caches()
+	files = {path.basename(f)[:-3]: f for f in sorted(glob.glob(path.join(modules_location, "*.py"))) if path.isfile(f) and not f.endswith('__init__.py')}
+	providers = {cp.name: cp for cp in ctx.command_providers}
+	changed = []
+	removed = 0
+
+	for mod in list(ctx.raw_imports):
+		if mod not in files:
+			if mod in providers:
+				unload_module(ctx, providers.pop(mod))
+			del ctx.raw_imports[mod]
+			del ctx.module_fingerprints[mod]
+			removed += 1
+			ctx.pyprint('Removed module: %s' % mod)
+
+	for mod, file in files.items():
+		try:
+			fp = fingerprint(file, ctx.module_fingerprints.get(mod))
+		except OSError as e:
+			ctx.pyprint('%s: Reading module %s' % (e, mod), 3)
+			continue
+		old = ctx.module_fingerprints.get(mod)
+		if not full and old is not None and old[2] == fp[2] and mod in providers:
+			ctx.module_fingerprints[mod] = fp # Only touched, no need to reload.
+			continue
+
+		start = time.perf_counter()
+		state = None
+		if mod in providers:
+			state = unload_module(ctx, providers.pop(mod))
+		try:
+			ctx.raw_imports[mod] = load_module(mod, file)
+			cp = ctx.raw_imports[mod].get_module()
+			cp.prefix = ctx.prefix
+			cp.scheduler = ctx.scheduler
+		except Exception as e:
+			ctx.pyprint('%s: Loading module %s, fix it and use "modules reload".' % (e, mod), 3)
+			ctx.module_fingerprints[mod] = fp
+			continue
+		try:
+			cp.set_state(state, ctx.server_config, ctx.writeline, ctx.event_bus)
+		except Exception as e:
+			ctx.pyprint('%s: Restoring the state of %s, it starts fresh.' % (e, mod), 2)
+		providers[mod] = cp
+		ctx.module_fingerprints[mod] = fp
+		ctx.module_times[mod] = time.perf_counter() - start
+		changed.append('%s (%.1fms)' % (mod, ctx.module_times[mod] * 1000))
+
+	ctx.command_providers = [providers[mod] for mod in files if mod in providers]
+	for cp in ctx.command_providers:
+		for warning in ctx.command_registry.register(cp):
+			ctx.pyprint(warning, 2)
+	if len(changed) > 0:
+		ctx.pyprint('Succesfully (re)loaded modules: %s' % ', '.join(changed))
+	elif removed == 0:
+		ctx.pyprint('All modules are up to date.')
+
+def show_help(ctx):
 	print('')
-	pyprint('Minecraft Commands should start with a "/" (e.g. /say, /help)')
+	ctx.pyprint('Minecraft Commands should start with a "/" (e.g. /say, /help)')
 	print('\n----- Built-in Commands -----')
 	print(' - help [MODULE]: Show this help, or the help page of a MODULE.')
-	print(' - modules <list|reload>: List pycraft modules or reload them.')
+	print(' - modules <list|reload [all]>: List pycraft modules or reload the changed (or all) modules.')
+	print(' - console: Show the console writer queue depth and write latency.')
+	print(' - jobs: List the module commands that are running or waiting.')
+	print(' - schedule list: List the scheduled jobs of the modules, with the time they run next.')
+	print(' - lag [MINUTES]: Show the lag spikes of the server (\'Can\'t keep up!\') in the last MINUTES (default 10).')
+	print(' - startup stats [VERSION]: Show the startup times per server version, or per phase for VERSION.')
 	print(' - stop|quit|exit: Stops the server and PyCraft (identical to /stop)')
+	if len(servers) > 1:
+		print('\n--- Servers ---')
+		print(' - @: List the servers.')
+		print(' - @<SERVER>: Send the following commands to SERVER.')
+		print(' - @<SERVER> <COMMAND>: Run COMMAND on SERVER only.')
+		print(' - @all <COMMAND>: Run COMMAND on all running servers.')
 	print('\n--- PyCraft Module Commands ---')
-	if len(command_providers) == 0:
+	if len(ctx.command_providers) == 0:
 		print(f' No PyCraft Server Modules were found in {modules_location}')
-	for cp in command_providers:
+	for cp in ctx.command_providers:
 		print(' - %s: %s' % (', '.join(cp.patterns), cp.description))
+	if len(ctx.command_registry.aliases) > 0:
+		print('\n--- Aliases ---')
+		for alias, cmd in ctx.command_registry.aliases.items():
+			print(' - %s: %s' % (alias, cmd))
 
-def handle_events(message):
-	for k in event_triggers:
-		et = event_triggers[k]
-		m = et.signature.match(message)
-		if m:
-			et.data = message
-			et.match = m
-			et.event.set()
-			et.event.clear()
-
-def perform_command(cmd, stdin):
-	global running
-	cmd_parts = cmd.split()
-	key, sub = pu.next_cmd(cmd_parts)
-
-	# Built-in
-	if (key == 'exit' or key == 'quit' or key == 'stop'):
-		if len(sub) > 0:
-			key2, sub2 = pu.next_cmd(sub)
-			if pu.max_cmd_len(sub2, 0, pyprint): return
-			if (key2 == 'FORCE'):
-				try:
-					write_to_console(stdin, 'stop\n')
-				except:
-					pass
-				running = False
-		else:
+def builtin_stop(ctx, sub):
+	if len(sub) > 0:
+		key2, sub2 = pu.next_cmd(sub)
+		if pu.max_cmd_len(sub2, 0, ctx.pyprint): return
+		if (key2 == 'FORCE'):
+			ctx.stop_requested.set()
 			try:
-				write_to_console(stdin, 'stop\n')
+				ctx.write('stop\n')
 			except:
 				pass
+			ctx.running = False
+	else:
+		ctx.stop_requested.set()
+		try:
+			ctx.write('stop\n')
+		except:
+			pass
+
+def builtin_help(ctx, sub):
+	if len(sub) > 0:
+		key2, sub2 = pu.next_cmd(ctx.command_registry.expand(sub))
+		try:
+			cp = ctx.command_registry.lookup(key2)
+		except Exception as e:
+			ctx.pyprint(str(e), 3)
+			return
+		if cp is not None:
+			cp.help(sub2)
+			return
+		ctx.pyprint('Unknown module/command: %s' % key2, 3)
+	else:
+		show_help(ctx)
+
+def builtin_console(ctx, sub):
+	if pu.max_cmd_len(sub, 0, ctx.pyprint): return
+	writer = ctx.console_writer
+	if writer is None:
+		ctx.pyprint('The server is not running.', 2)
 		return
-	if (key == 'help'):
-		if len(sub) > 0:
-			key2, sub2 = pu.next_cmd(sub)
-			for cp in command_providers:
-				if cp.matches(key2):
-					cp.help(sub2)
-					return
-			pyprint('Unknown module/command: %s' % key2, 3)
-		else:
-			show_help()
+	last, avg, worst = writer.latency()
+	ctx.pyprint('Console writer: %d queued, %d messages in %d writes, latency last %.1fms, avg %.1fms, max %.1fms' % (writer.depth(), writer.messages, writer.writes, last * 1000, avg * 1000, worst * 1000))
+
+def builtin_jobs(ctx, sub):
+	if pu.max_cmd_len(sub, 0, ctx.pyprint): return
+	jobs = ctx.command_jobs.list()
+	if len(jobs) == 0:
+		ctx.pyprint('No commands are running.')
+	for job in jobs:
+		state = 'waiting' if job.started is None else 'running'
+		ctx.pyprint('#%d %s (%s for %.1fs)' % (job.id, job.command, state, job.elapsed()))
+
+def builtin_schedule(ctx, sub):
+	key2, sub2 = pu.next_cmd(sub)
+	if pu.max_cmd_len(sub2, 0, ctx.pyprint): return
+	if (key2 != 'list'):
+		ctx.pyprint('Usage: schedule list', 3)
 		return
-	if (key == 'modules'):
-		key2, sub2 = pu.next_cmd(sub)
-		if pu.max_cmd_len(sub2, 0, pyprint): return
-		if (key2 == 'reload'): import_tool()
-		elif (key2 == 'list'): pyprint('Active modules: %s' % list_modules())
+	jobs = ctx.scheduler.list()
+	if len(jobs) == 0:
+		ctx.pyprint('No jobs are scheduled.')
+	now = time.time()
+	for job in jobs:
+		state = ', running' if job.running else ''
+		ctx.pyprint('#%d %s (%s, %s%s): next at %s (in %.0fs)' % (job.id, job.name, job.owner, job.kind(), state, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job.due)), job.due - now))
+
+def builtin_modules(ctx, sub):
+	key2, sub2 = pu.next_cmd(sub)
+	if (key2 == 'reload'):
+		key3, sub3 = pu.next_cmd(sub2)
+		if pu.max_cmd_len(sub3, 0, ctx.pyprint): return
+		import_tool(ctx, key3 == 'all')
+		return
+	if pu.max_cmd_len(sub2, 0, ctx.pyprint): return
+	if (key2 == 'list'): ctx.pyprint('Active modules: %s' % list_modules(ctx))
+
+def builtin_lag(ctx, sub):
+	key2, sub2 = pu.next_cmd(sub)
+	if pu.max_cmd_len(sub2, 0, ctx.pyprint): return
+	try:
+		minutes = 10 if key2 is None else float(key2)
+	except ValueError:
+		ctx.pyprint('Usage: lag [MINUTES]', 3)
+		return
+	tracker = ctx.event_bus.lag
+	spikes, total, worst = tracker.stats(minutes * 60)
+	ctx.pyprint(f'Lag in the last {minutes:g} minutes: {spikes} spikes, {total}ms behind in total, worst spike {worst}ms.')
+	for start, n, ms, most in tracker.recent(minutes * 60):
+		print(f'{ctx.prefix}  {time.strftime("%H:%M", time.localtime(start))} {n:5d} spikes {ms:8d}ms behind (worst {most}ms)')
+
+def builtin_startup(ctx, sub):
+	key2, sub2 = pu.next_cmd(sub)
+	if (key2 == 'stats'):
+		key3, sub3 = pu.next_cmd(sub2)
+		if pu.max_cmd_len(sub3, 0, ctx.pyprint): return
+		show_startup_stats(ctx, key3)
+		return
+	ctx.pyprint('Usage: startup stats [VERSION]', 3)
+
+builtin_commands = {
+	'stop': builtin_stop,
+	'quit': builtin_stop,
+	'exit': builtin_stop,
+	'help': builtin_help,
+	'console': builtin_console,
+	'jobs': builtin_jobs,
+	'schedule': builtin_schedule,
+	'modules': builtin_modules,
+	'lag': builtin_lag,
+	'startup': builtin_startup,
+}
+
+def perform_command(ctx, cmd):
+	cmd_parts = ctx.command_registry.expand(cmd.split())
+	key, sub = pu.next_cmd(cmd_parts)
+
+	# Built-in (exact names only, a prefix should never stop the server)
+	builtin = builtin_commands.get(key)
+	if builtin is not None:
+		builtin(ctx, sub)
 		return
 	# Modules
-	for cp in command_providers:
-		if cp.matches(key):
-			try:
-				cp.execute(sub, server_config, lambda msg: write_to_console(stdin, msg + "\n"), event_triggers)
-			except Exception as e:
-				pyprint('%s: Performing command: %s' % (e, cmd), 3)
-			return
-	pyprint('Unknown command: %s' % cmd, 3)
+	try:
+		cp = ctx.command_registry.lookup(key)
+	except Exception as e:
+		ctx.pyprint(str(e), 3)
+		return
+	if cp is None:
+		ctx.pyprint('Unknown command: %s' % cmd, 3)
+		return
+
+	def run():
+		try:
+			pu.run_awaitable(cp.execute(sub, ctx.server_config, ctx.writeline, ctx.event_bus), ctx.event_loop)
+		except Exception as e:
+			ctx.pyprint('%s: Performing command: %s' % (e, cmd), 3)
+	try:
+		ctx.command_jobs.submit(cp.name, cmd, run, cp.max_concurrency)
+	except Exception as e:
+		ctx.pyprint('%s: Rejected command: %s' % (e, cmd), 3)
 
-def initial_commands(stdin):
-	for cmd in server_config['initialize']:
+def initial_commands(ctx):
+	for cmd in ctx.server_config['initialize']:
 		s = cmd.strip()
-		if s.startswith('/'): write_to_console(stdin, '%s\n' % s[1:])
-		elif len(s) > 0: perform_command(s, stdin)
+		if s.startswith('/'): ctx.write('%s\n' % s[1:])
+		elif len(s) > 0: perform_command(ctx, s)
 
 def ask_server_type(config):
 	while True:
@@ -583,111 +1141,392 @@ def ask_server_type(config):
 			except ValueError:
 				print(f"{c} is not a valid option! (case-sensitive)")
 
-def write_to_console(stdin, msg):
+def encode_for_console(msg):
 	'''
-	stdin: The server console stdin (in bytes mode without bufsize or encoding)
 	msg: The message as a utf-8 encoded string.
+	Returns the message as modified utf-8 bytes, as expected by the server console.
 	'''
-	utf8m_b = None
-	
-	try:
-		msg_b = msg.encode("utf-8")
-		utf8m_b = utf8m.utf8s_to_utf8m(msg_b)
-	except Exception as e:
-		pyprint(f'Failed to write to console {e}', 3)
+	return utf8m.utf8s_to_utf8m(msg.encode("utf-8"))
+
+def perform_input(ctx, line):
+	'''
+	Handles a line typed in the console.
+	'''
+	s = line.strip()
+	if s.startswith('/'):
+		try:
+			ctx.write(s[1:] + '\n')
+		except Exception as e:
+			ctx.pyprint('%s: Performing command: %s' % (e, s), 3)
+	elif len(s) > 0: perform_command(ctx, s)
+
+def handle_output(ctx, lines):
+	'''
+	Prints lines read from the server console and publishes them as events.
+	'''
+	records = [ctx.event_dispatcher.parse(line) for line in lines if len(line.strip()) != 0]
+	if len(records) == 0:
 		return
+	sys.stdout.write(''.join(ctx.prefix + r.line + '\n' for r in records))
+	sys.stdout.flush()
+	if not ctx.done:
+		startup_progress(ctx, records)
+	for record in records:
+		if record.event == 'stop':
+			ctx.stop_seen = True
+		ctx.event_bus.publish(record)
+
+def startup_progress(ctx, records):
+	'''
+	Marks the first line, the start of the world load and the done event of the server while it is starting.
+	'''
+	if len(ctx.timeline) > 0 and ctx.timeline[-1][0] == 'jvm spawn':
+		ctx.mark('first line')
+	for record in records:
+		if record.body is not None and record.body.startswith('Preparing level') and ctx.timeline[-1][0] == 'first line':
+			ctx.mark('preparing level')
+		elif record.event == 'done':
+			ctx.mark('done')
+			ctx.done = True
+			save_startup(ctx, pycraft_events.startup_seconds(record))
+			if profile_startup:
+				print_startup_profile(ctx)
+			return
 
-	# Write to console stdin and flush (raw bytes)
-	stdin.write(utf8m_b)
-	stdin.flush()
+def print_startup_profile(ctx):
+	ctx.pyprint('Startup profile (phase, duration, time since the launch began):')
+	prev = ctx.launch_time
+	for phase, t in ctx.timeline:
+		print(f'{ctx.prefix}  {phase:<15} {(t - prev) * 1000:9.1f}ms {(t - ctx.launch_time) * 1000:9.1f}ms')
+		prev = t
+	if ctx.restarts > 0:
+		return # The modules were loaded for the first launch.
+	print(f'{ctx.prefix}  Module load times (including their imports):')
+	for mod, t in sorted(ctx.module_times.items(), key=lambda m: -m[1]):
+		print(f'{ctx.prefix}  - {mod:<16} {t * 1000:7.1f}ms')
+
+def save_startup(ctx, reported):
+	'''
+	Appends the timeline of the launch that just got done to the startup history of the server.
+	reported: The startup time the server printed itself (Done (X.XXXs)!), None if unknown.
+	'''
+	phases = {}
+	prev = ctx.launch_time
+	for phase, t in ctx.timeline:
+		phases[phase] = round(t - prev, 3)
+		prev = t
+	spawned = next(t for phase, t in ctx.timeline if phase == 'jvm spawn')
+	entry = {
+		'time': int(time.time()),
+		'version': ctx.server_version['id'],
+		'restart': ctx.restarts > 0,
+		'cds': ctx.cds_state,
+		'server': round(ctx.timeline[-1][1] - spawned, 3), # From spawning the JVM until done.
+		'reported': reported,
+		'phases': phases,
+	}
+	history_file = path.join(servers_location, ctx.name, cache_location, startup_history_file)
+	try:
+		os.makedirs(path.dirname(history_file), exist_ok=True)
+		with open(history_file, 'a') as f:
+			f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+	except OSError as e:
+		ctx.pyprint(f'Could not save the startup time {e}', 2)
 
-def readline_from_console(stdout):
+def read_startup_history(ctx):
 	'''
-	stdout: The stdout (bytes, but encoding will be locale.getpreferredencoding())
+	Returns the entries of the startup history of the server, oldest first.
 	'''
-	msg = None
+	history = []
+	history_file = path.join(servers_location, ctx.name, cache_location, startup_history_file)
 	try:
-		inp_b = stdout.readline()
-		msg = inp_b.decode(encoding_inbound).rstrip('\r\n')
-	except Exception as e:
-		pyprint(f'Failed to read from console {e}', 3)
-		return ""
+		with open(history_file, 'r') as f:
+			for line in f:
+				try:
+					history.append(json.loads(line))
+				except ValueError:
+					pass # A line cut off by a crash.
+	except OSError:
+		pass
+	return history
+
+def show_startup_stats(ctx, version=None):
+	'''
+	Shows the startup time percentiles per server version (in the order they were first run), and flags versions
+	that start slower than the version before them. With version, shows the percentiles per phase of that version.
+	'''
+	by_version = {}
+	for entry in read_startup_history(ctx):
+		by_version.setdefault(entry['version'], []).append(entry)
+	if len(by_version) == 0:
+		ctx.pyprint('No startup history yet, it is saved every time the server is done starting.')
+		return
 
-	return msg
+	if version is not None:
+		entries = by_version.get(version)
+		if entries is None:
+			ctx.pyprint('No startup history for version %s, known versions: %s' % (version, ', '.join(by_version)), 3)
+			return
+		phases = {}
+		for entry in entries:
+			for phase, t in entry['phases'].items():
+				phases.setdefault(phase, []).append(t)
+		ctx.pyprint(f'Startup phases of {version} ({len(entries)} launches, in seconds):')
+		print(f'{ctx.prefix}  {"phase":<15} {"runs":>5} {"p50":>8} {"p90":>8} {"max":>8}')
+		for phase, times in phases.items():
+			print(f'{ctx.prefix}  {phase:<15} {len(times):5d} {pu.percentile(times, 50):8.3f} {pu.percentile(times, 90):8.3f} {max(times):8.3f}')
+		return
 
-def main():
-	global running, encoding_inbound
+	ctx.pyprint('Startup times per version (seconds from spawning the JVM until done, and as reported by the server):')
+	print(f'{ctx.prefix}  {"version":<16} {"runs":>5} {"p50":>8} {"p90":>8} {"max":>8} {"reported":>9}')
+	prev = None
+	for v, entries in by_version.items():
+		times = [e['server'] for e in entries]
+		reported = [e['reported'] for e in entries if e.get('reported') is not None]
+		p50 = pu.percentile(times, 50)
+		line = f'{ctx.prefix}  {v:<16} {len(times):5d} {p50:8.3f} {pu.percentile(times, 90):8.3f} {max(times):8.3f}'
+		line += f' {pu.percentile(reported, 50):9.3f}' if len(reported) > 0 else f' {"-":>9}'
+		if prev is not None and p50 > prev[1] * startup_regression and p50 - prev[1] >= startup_regression_min:
+			line += f'  REGRESSION +{(p50 / prev[1] - 1) * 100:.0f}% since {prev[0]}'
+		print(line)
+		prev = (v, p50)
+
+	for v, entries in by_version.items():
+		shared = [e['server'] for e in entries if e.get('cds') == 'on']
+		unshared = [e['server'] for e in entries if e.get('cds') != 'on']
+		if len(shared) > 0 and len(unshared) > 0:
+			a = pu.percentile(unshared, 50)
+			b = pu.percentile(shared, 50)
+			ctx.pyprint(f'{v}: The class data sharing archive changes the p50 by {b - a:+.3f}s ({(b / a - 1) * 100:+.0f}%), {len(shared)} launches with and {len(unshared)} without.')
+
+def shutdown_modules(ctx):
+	ctx.command_jobs.close()
+	ctx.scheduler.close()
+	close_modules(ctx)
+	ctx.event_bus.close()
+
+def restart_delay(ctx):
+	'''
+	Returns the seconds to wait before restarting the server after it exited, None if it shouldn't be restarted.
+	The server is only restarted if it crashed (exited without logging that it stops) and auto-restart is on.
+	'''
+	if ctx.stop_seen or ctx.stop_requested.is_set() or not ctx.server_config.get('auto-restart', False):
+		return None
+	now = time.time()
+	while len(ctx.crashes) > 0 and now - ctx.crashes[0] > crash_loop_window:
+		ctx.crashes.popleft()
+	ctx.crashes.append(now)
+	if len(ctx.crashes) > crash_loop_limit:
+		ctx.pyprint('Server crashed %d times within %d minutes, it will not be restarted.' % (len(ctx.crashes), crash_loop_window // 60), 3)
+		return None
+	return min(restart_backoff_max, restart_backoff * 2 ** (len(ctx.crashes) - 1))
+
+def run_server(ctx):
+	'''
+	Runs the server until it stops, using threads for console input and output.
+	With auto-restart it is restarted after a crash, using the same launch code, modules and events.
+	'''
+	def print_callback():
+		initial_commands(ctx)
 
-	pyprint(f'Version: {pycraft_server_version}')
-	if DEBUG: pyprint('DEBUG is enabled!')
+		while True:
+			line = ctx.input_queue.get()
+			if line is None: break # Shutdown sentinel.
+			if not ctx.running: continue # Discard anything left after the server terminated.
+			perform_input(ctx, line)
 
-	import_tool()
-	config = read_config()
-	args = arguments()
+	print_thread = None
+	while True:
+		if print_thread is not None:
+			ctx.relaunch() # Restarting after a crash.
+		ctx.stop_seen = False
+		try:
+			process = launch_server(ctx)
+		except Exception as e:
+			ctx.pyprint(f'Failed to launch the server {e}', 3)
+			break
+		ctx.mark('jvm spawn')
+		ctx.console_writer = pycraft_console.ConsoleWriter(process.stdin, encode_for_console)
+		if print_thread is None:
+			print_thread = Thread(target=print_callback, name=f'pycraft-input-{ctx.name}')
+			print_thread.start()
+
+		# stdout: The stdout (unbuffered bytes, but encoding will be locale.getpreferredencoding())
+		reader = pycraft_console.LineReader(process.stdout, ctx.encoding_inbound)
+		while True:
+			try:
+				lines = reader.read()
+			except Exception as e:
+				ctx.pyprint(f'Failed to read from console {e}', 3)
+				break
+			if lines is None:
+				break
+			handle_output(ctx, lines)
+		rc = process.wait()
+		finish_class_data_sharing(ctx)
+
+		writer = ctx.console_writer
+		ctx.console_writer = None
+		writer.close(1)
+		delay = restart_delay(ctx)
+		if delay is None:
+			break
+		ctx.pyprint(f'Server crashed (exit code {rc}), restarting in {delay}s...', 2)
+		if ctx.stop_requested.wait(delay):
+			break
 
-	if args.server_name is None:
-		x = ask_server_type(config)
-		if x is None:
-			return
-		args.server_name = x
-	
-	launch_code = obtain_launch_code(config, args)
-	print(f"Version: {server_version['name']}")
+	ctx.running = False
+	shutdown_modules(ctx)
 
-	# This is the encoding used when reading from server console.
-	if encoding_inbound is None:
-		encoding_inbound = locale.getpreferredencoding()
-	pyprint(f'Inbound Encoding: {encoding_inbound}')
+	ctx.input_queue.put(None) # Wake up the command thread so it can finish.
+	if print_thread is not None:
+		print_thread.join()
+	if ctx.stop_seen or ctx.stop_requested.is_set():
+		ctx.pyprint('Server has terminated succesfully!')
+	else:
+		ctx.pyprint('Server has terminated unexpectedly!', 3)
 
+def run_servers():
+	'''
+	Runs every server on its own thread, until all of them terminate. Console input is routed by a single thread.
+	'''
+	threads = [Thread(target=run_server, args=(ctx,), name=f'pycraft-{ctx.name}') for ctx in servers.values()]
+	for ctx in servers.values():
+		ctx.running = True
+	for thread in threads:
+		thread.start()
+	input_thread = Thread(target=add_input, name='pycraft-stdin')
+	input_thread.daemon = True
+	input_thread.start()
+	for thread in threads:
+		thread.join()
 
-	launch_str = ' '.join(launch_code)
-	server_name = args.server_name
-	pyprint(f'Launching "{server_name}"...')
-	pyprint(f'With command "{launch_str}"', 0)
-	process = launch_server(args.server_name, launch_code)
-	
-	running = True
-	def print_callback(input_queue):
-		nonlocal process
-		global running, read_flag
-
-		initial_commands(process.stdin)
-
-		while running:
-			with read_condition:
-				read_condition.wait()
-			if read_flag:
-				queue_lock.acquire()
-				s = ''
-				while not input_queue.empty():
-					s += input_queue.get()
-				if s.startswith('/'): write_to_console(process.stdin, s[1:])
-				elif len(s.strip()) > 0: perform_command(s.strip(), process.stdin)
-				read_flag = False
-				queue_lock.release()
-
-	input_queue = Queue()
-	input_thread = Thread(target=add_input, args=(input_queue,))
+async def run_server_async(ctx):
+	'''
+	Runs the server until it stops, on the running asyncio event loop. Restarts it like run_server.
+	Module commands and blocking console input still run on threads, async module callbacks run on the loop.
+	'''
+	import asyncio
+	loop = ctx.event_loop
+	ctx.event_bus.loop = loop
+	ctx.scheduler.loop = loop
+
+	async def print_callback():
+		await loop.run_in_executor(None, initial_commands, ctx)
+
+		while True:
+			line = await ctx.input_queue.get()
+			await loop.run_in_executor(None, perform_input, ctx, line)
+
+	print_task = None
+	while True:
+		if print_task is not None:
+			ctx.relaunch() # Restarting after a crash.
+		ctx.stop_seen = False
+		try:
+			process = await asyncio.create_subprocess_exec(*launch_command(ctx), stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=path.join(servers_location, ctx.name))
+		except Exception as e:
+			ctx.pyprint(f'Failed to launch the server {e}', 3)
+			break
+		ctx.mark('jvm spawn')
+		ctx.console_writer = pycraft_console.AsyncConsoleWriter(process.stdin, encode_for_console, loop)
+		if print_task is None:
+			print_task = loop.create_task(print_callback())
+
+		reader = pycraft_console.LineReader(None, ctx.encoding_inbound)
+		while True:
+			data = await process.stdout.read(len(reader.buffer))
+			if not data:
+				break
+			handle_output(ctx, reader.feed(data))
+		handle_output(ctx, reader.finish() or [])
+		rc = await process.wait()
+		finish_class_data_sharing(ctx)
+
+		writer = ctx.console_writer
+		ctx.console_writer = None
+		await writer.close()
+		delay = restart_delay(ctx)
+		if delay is None:
+			break
+		ctx.pyprint(f'Server crashed (exit code {rc}), restarting in {delay}s...', 2)
+		if await loop.run_in_executor(None, ctx.stop_requested.wait, delay):
+			break
+
+	ctx.running = False
+	if print_task is not None:
+		print_task.cancel()
+	await loop.run_in_executor(None, shutdown_modules, ctx)
+	if ctx.stop_seen or ctx.stop_requested.is_set():
+		ctx.pyprint('Server has terminated succesfully!')
+	else:
+		ctx.pyprint('Server has terminated unexpectedly!', 3)
+
+async def run_servers_async():
+	'''
+	Runs all servers on a single asyncio event loop, until all of them terminate.
+	'''
+	import asyncio
+	loop = asyncio.get_running_loop()
+	for ctx in servers.values():
+		ctx.event_loop = loop
+		ctx.input_queue = asyncio.Queue(maxsize=input_queue_size)
+		ctx.running = True
+	input_thread = Thread(target=add_input, name='pycraft-stdin')
 	input_thread.daemon = True
 	input_thread.start()
-	print_thread = Thread(target=print_callback, args=(input_queue,))
-	print_thread.start()
+	await asyncio.gather(*(run_server_async(ctx) for ctx in servers.values()))
 
-	while (process.poll() == None):
-		message = readline_from_console(process.stdout)
+def main():
+	global selected_server, profile_startup, cohosted_servers
 
-		if len(message.strip()) != 0:
-			print(message)
-			handle_events(message)
-	
-	running = False
+	pyprint(f'Version: {pycraft_server_version}')
+	if DEBUG: pyprint('DEBUG is enabled!')
 
-	for cp in command_providers:
-		cp.close() # Kill any threads first.
-	
-	with read_condition:
-		read_condition.notify() # Remove the condition
-	print_thread.join()
-	pyprint('Server has terminated succesfully!')
+	config = read_config()
+	command_aliases = config.get('command-aliases', {})
+	expect_type('command-aliases', command_aliases, dict)
+	args = arguments()
+	profile_startup = args.profile_startup
+	config_time = time.perf_counter()
+
+	server_names = args.server_names
+	if args.all:
+		server_names = [s['name'] for s in config['server-list']]
+	if len(server_names) == 0:
+		x = ask_server_type(config)
+		if x is None:
+			return
+		server_names = [x]
+	cohosted_servers = server_names
+
+	for server_name in server_names:
+		if server_name in servers:
+			continue
+		ctx = ServerContext(server_name, f'[{server_name}] ' if len(server_names) > 1 else '')
+		ctx.command_registry.aliases = command_aliases
+		ctx.timeline = [('imports', imports_time), ('config', config_time)]
+		import_tool(ctx)
+		ctx.mark('modules')
+		obtain_cached_launch_code(ctx, config, args)
+		ctx.mark('launch plan')
+		ctx.pyprint(f"Version: {ctx.server_version['name']}")
+
+		# This is the encoding used when reading from server console.
+		if ctx.encoding_inbound is None:
+			ctx.encoding_inbound = locale.getpreferredencoding()
+		ctx.pyprint(f'Inbound Encoding: {ctx.encoding_inbound}')
+
+		launch_str = ' '.join(ctx.launch_code)
+		ctx.pyprint(f'Launching "{server_name}"...')
+		ctx.pyprint(f'With command "{launch_str}"', 0)
+		servers[server_name] = ctx
+
+	selected_server = server_names[0]
+	if args.use_asyncio:
+		import asyncio
+		asyncio.run(run_servers_async())
+	else:
+		run_servers()
 
-if __name__ == '__main__': main()
\ No newline at end of file
+if __name__ == '__main__': main()
@@ -0,0 +1,302 @@
+'''
+Fast I/O with the server console.
+
+The server can print a lot of lines in a short time (chunk loading, command blocks, etc.), if we fall behind, the pipe
+fills up and the logging thread of the server stalls. So the console is read in large chunks into a reusable buffer.
+The other way around, when the server doesn't read its input for a while (e.g. during a long save), writing to it
+would block. So the console is written by a separate thread.
+'''
+
+import codecs
+import time
+
+from concurrent.futures import Future
+from threading import Thread
+from queue import Queue
+from queue import Empty
+
+
+class LineReader:
+    '''
+    Reads lines from a binary stream in large chunks.
+    Lines are split in the buffer without copying and decoded incrementally, so multibyte characters split over two
+    reads are kept intact and invalid bytes are replaced instead of losing the line.
+    '''
+
+    def __init__(self, stream, encoding, buffer_size=1 << 16):
+        '''
+        stream: An unbuffered binary stream (e.g. Popen stdout with bufsize=0), None when only using feed().
+        encoding: The encoding of the stream.
+        buffer_size: The size of a single read.
+        '''
+        self.stream = stream
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self.start = 0 # Start of the incomplete line in the buffer.
+        self.end = 0 # End of the data in the buffer.
+        self.pending = '' # Decoded start of a line which did not fit in the buffer.
+
+    def read(self):
+        '''
+        Blocks until data is available and returns the complete lines read (without line endings).
+        Returns None when the end of the stream was reached.
+        '''
+        n = self.stream.readinto(self.free())
+        if not n:
+            return self.finish()
+        return self.split(n)
+
+    def feed(self, data):
+        '''
+        Returns the complete lines after adding data, for when the data was read elsewhere (e.g. asyncio streams).
+        '''
+        lines = []
+        data = memoryview(data)
+        while len(data) > 0:
+            free = self.free()
+            n = min(len(free), len(data))
+            free[:n] = data[:n]
+            data = data[n:]
+            lines += self.split(n)
+        return lines
+
+    def free(self):
+        '''
+        Returns the free part of the buffer to read into.
+        '''
+        if self.start > 0:
+            # Move the incomplete line to the front.
+            n = self.end - self.start
+            self.buffer[:n] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = n
+        elif self.end == len(self.buffer):
+            # The line doesn't fit, keep the decoded part.
+            self.pending += self.decoder.decode(self.view[:self.end])
+            self.end = 0
+        return self.view[self.end:]
+
+    def split(self, n):
+        '''
+        Returns the complete lines after n bytes were read into the free part of the buffer.
+        '''
+        lines = []
+        pos = self.end
+        self.end += n
+        while True:
+            i = self.buffer.find(b'\n', pos, self.end)
+            if i < 0:
+                break
+            line = self.decoder.decode(self.view[self.start:i + 1])
+            if len(self.pending) > 0:
+                line = self.pending + line
+                self.pending = ''
+            lines.append(line.rstrip('\r\n'))
+            self.start = pos = i + 1
+        if self.start == self.end:
+            self.start = self.end = 0
+        return lines
+
+    def finish(self):
+        '''
+        Returns the last line (without line ending) at the end of the stream, or None if there is none.
+        '''
+        if self.end == self.start and len(self.pending) == 0:
+            return None
+        last = self.pending + self.decoder.decode(self.view[self.start:self.end], True)
+        self.pending = ''
+        self.start = self.end = 0
+        return [last.rstrip('\r')]
+
+
+class WriterStats:
+    '''
+    Queue depth and latency statistics of a console writer.
+    '''
+
+    def __init__(self):
+        self.writes = 0
+        self.messages = 0
+        self.latency_total = 0
+        self.latency_max = 0
+        self.latency_last = 0
+
+    def depth(self):
+        '''
+        Returns the amount of messages waiting to be written.
+        '''
+        return self.queue.qsize()
+
+    def latency(self):
+        '''
+        Returns the (last, average, max) time in seconds between queueing and flushing a message.
+        '''
+        avg = self.latency_total / self.messages if self.messages > 0 else 0
+        return self.latency_last, avg, self.latency_max
+
+    def encode_batch(self, batch):
+        '''
+        Returns the encoded data of the batch and the (future, queued) of the messages in it.
+        '''
+        data = []
+        written = []
+        for msg, future, queued in batch:
+            try:
+                data.append(self.encode(msg))
+                written.append((future, queued))
+            except Exception as e:
+                print(f'[PyCraft/ERROR] Failed to write to console {e}')
+                if future is not None:
+                    future.set_exception(e)
+        return b''.join(data), written
+
+    def finish_batch(self, written, error=None):
+        if error is not None:
+            print(f'[PyCraft/ERROR] Failed to write to console {error}')
+            for future, queued in written:
+                if future is not None:
+                    future.set_exception(error)
+            return
+
+        now = time.perf_counter()
+        self.writes += 1
+        for future, queued in written:
+            latency = now - queued
+            self.messages += 1
+            self.latency_total += latency
+            self.latency_last = latency
+            self.latency_max = max(self.latency_max, latency)
+            if future is not None:
+                future.set_result(None)
+
+
+class ConsoleWriter(WriterStats):
+    '''
+    Writes to a binary stream on its own thread, so callers never block when the server is not reading its input.
+    Messages queued while a write is in progress are coalesced into a single write and flush.
+    '''
+
+    def __init__(self, stream, encode):
+        '''
+        stream: An unbuffered binary stream (e.g. Popen stdin with bufsize=0).
+        encode: Function converting a message to bytes, may raise an exception to reject the message.
+        '''
+        super().__init__()
+        self.stream = stream
+        self.encode = encode
+        self.queue = Queue()
+        self.thread = Thread(target=self.run, name='pycraft-console-writer', daemon=True)
+        self.thread.start()
+
+    def write(self, msg):
+        '''
+        Queues the message and returns immediately (fire-and-forget).
+        '''
+        self.queue.put((msg, None, time.perf_counter()))
+
+    def submit(self, msg):
+        '''
+        Queues the message and returns a Future which is done once the message was flushed (or failed).
+        '''
+        future = Future()
+        self.queue.put((msg, future, time.perf_counter()))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            closing = batch[-1] is None
+            if closing:
+                batch.pop()
+            if len(batch) > 0:
+                self.write_batch(batch)
+            if closing:
+                return
+
+    def write_batch(self, batch):
+        data, written = self.encode_batch(batch)
+        try:
+            view = memoryview(data)
+            while len(view) > 0:
+                n = self.stream.write(view)
+                view = view[n:]
+            self.stream.flush()
+        except Exception as e:
+            self.finish_batch(written, e)
+            return
+        self.finish_batch(written)
+
+    def close(self, timeout=None):
+        '''
+        Writes the remaining messages and stops the thread.
+        '''
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+
+class AsyncConsoleWriter(WriterStats):
+    '''
+    The ConsoleWriter for the asyncio core: a task writing to an asyncio StreamWriter.
+    write() and submit() may be called from any thread.
+    '''
+
+    def __init__(self, stream, encode, loop):
+        '''
+        stream: The asyncio StreamWriter (e.g. the stdin of an asyncio subprocess).
+        encode: Function converting a message to bytes, may raise an exception to reject the message.
+        loop: The running event loop.
+        '''
+        import asyncio # Only needed by the asyncio core.
+        super().__init__()
+        self.stream = stream
+        self.encode = encode
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.task = loop.create_task(self.run())
+
+    def write(self, msg):
+        '''
+        Queues the message and returns immediately (fire-and-forget).
+        '''
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (msg, None, time.perf_counter()))
+
+    def submit(self, msg):
+        '''
+        Queues the message and returns a (concurrent) Future which is done once the message was flushed (or failed).
+        '''
+        future = Future()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (msg, future, time.perf_counter()))
+        return future
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while batch[-1] is not None and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            closing = batch[-1] is None
+            if closing:
+                batch.pop()
+            if len(batch) > 0:
+                data, written = self.encode_batch(batch)
+                try:
+                    self.stream.write(data)
+                    await self.stream.drain()
+                except Exception as e:
+                    self.finish_batch(written, e)
+                else:
+                    self.finish_batch(written)
+            if closing:
+                return
+
+    async def close(self):
+        '''
+        Writes the remaining messages and stops the task.
+        '''
+        self.queue.put_nowait(None)
+        await self.task
@@ -0,0 +1,418 @@
+'''
+Recognizes server events from lines printed on the server console.
+
+Every console line starts with the same timestamp/log level header. Instead of matching a full regex per event,
+the header is parsed once and the message body is routed by a cheap literal check. The body regex of an event is
+only run on the lines that pass that check.
+
+The result is a LogRecord, which is created once per line and published on the EventBus, which delivers it to
+every subscriber of that event. The bus also keeps track of the lag spikes (LagTracker) and the players online
+(PlayerTracker) of the server.
+'''
+
+import pycraft_utils as pu
+import time
+import re
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from threading import Condition
+from threading import Lock
+
+date_pattern = '\\d{4}-\\d{2}-\\d{2}'
+time_pattern = '\\d{1,2}:\\d{1,2}:\\d{1,2}'
+thread_pattern = '[a-zA-Z\\s]*?(?:|#\\d+)'
+level_pattern = '[A-Z].*?'
+
+name_pattern = '[a-zA-Z0-9_]+?' # Use this when you don't use pre-/suffixes (safer)
+ps_name_pattern = '[^<*].*' # Can be anything because of pre-/suffixes BUT disallows < and > usage. (more lenient, less safe)
+
+float_pattern = "-?[0-9]+\\.[0-9]+"
+uuid_pattern = "[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+lag_pattern = 'Running (?P<ms>\\d+)ms (?:or |behind, skipping )(?P<ticks>\\d+) tick'
+startup_time_pattern = '\\((?P<startup>[0-9.]+)(?P<unit>[nmhs]{1,2})\\)'
+
+header = re.compile(f'^\\[(?P<time>{time_pattern})\\] \\[(?P<thread>{thread_pattern})\\/(?P<level>{level_pattern})\\]: (?P<body>.*)')
+legacy_header = re.compile(f'^(?P<date>{date_pattern}) (?P<time>{time_pattern}) \\[(?P<level>INFO|WARNING|SEVERE)\\] (?P<body>.*)')
+
+# (event name, literal, literal must be at the start of the body, body regex)
+# The literals of different events exclude each other, so a line triggers at most one of these events (and 'any').
+signatures = [
+    ('done', 'Done (', True, re.compile(f'Done {startup_time_pattern}! For help, type "help"')),
+    ('save', 'Saved the game', True, re.compile('Saved the game')),
+    ('stop', 'Stopping server', True, re.compile('Stopping server')),
+    ('join', 'UUID of player ', True, re.compile(f'UUID of player (?P<player>{name_pattern}) is {uuid_pattern}$')),
+    ('leave', ' lost connection: ', False, re.compile(f'(?P<player>{name_pattern}) lost connection: .*$')),
+    ('chat', '<', True, re.compile('<(?P<player>[^>]*)> .*')),
+    ('server-chat', '[Server] ', True, re.compile('\\[Server\\] .*')), # Not safe. May also trigger on entities or commandblocks named 'Server' performing the /say command.
+    ('emote', '* ', True, re.compile('\\* [^ ]*? .*')),
+    ('lag', "Can't keep up!", True, re.compile(f"Can't keep up! .*?{lag_pattern}")),
+]
+
+legacy_signatures = [
+    ('done', 'Done (', True, re.compile(f'Done {startup_time_pattern}! For help, type "help" or "\\?"$')),
+    ('save', 'CONSOLE: Save complete.', True, re.compile('CONSOLE: Save complete\\.$')),
+    ('stop', 'Stopping server', True, re.compile('Stopping server$')),
+    ('join', ' logged in with entity id ', False, re.compile(f'(?P<player>{name_pattern}) \\[[0-9a-zA-Z_./:-]+\\] logged in with entity id \\d{{1,10}} at \\({float_pattern}, {float_pattern}, {float_pattern}\\)$')),
+    ('leave', ' lost connection: ', False, re.compile(f'(?P<player>{name_pattern}) lost connection: .*$')),
+    ('chat', '<', True, re.compile('<(?P<player>[^>]*)> .*')),
+    ('server-chat', '[CONSOLE] ', True, re.compile('\\[CONSOLE\\] .*')), # Triggers on any output from the console.
+    ('emote', '* ', True, re.compile('\\* [^ ]*? .*')),
+    ('lag', "Can't keep up!", True, re.compile(f"Can't keep up! (?:.*?{lag_pattern})?")), # Old versions don't print how far behind.
+]
+
+# All event names:
+# - done: Triggers when the server is done loading and is ready to receive commands.
+# - save: Triggers when the server is saved using save-all.
+# - stop: Triggers when the server is stopped. (for shutdown hooks)
+# - join: Triggers when a player joins the server.
+# - leave: Triggers when a player leaves the server.
+# - chat: Triggers on any chat message (starting with <NAME>)
+# - server-chat: Triggers on any chat message sent by the SERVER ONLY. (or a player named Server, be careful, don't give them '/say' access)
+# - emote: Triggers on all emotes (lines starting with *).
+# - lag: Triggers when the server can't keep up with its ticks (a lag spike), see lag_ms.
+# - any: Triggers on every line that has a valid header, useful for partially regexxing.
+event_names = [s[0] for s in signatures] + ['any']
+
+
+class LogRecord:
+    '''
+    A console line, parsed once.
+    line: The raw line (without line ending).
+    date: The date (legacy log format only, else None).
+    time: The time of day as printed by the server.
+    thread: The thread name (None for the legacy log format).
+    level: The log level, e.g. INFO or WARN.
+    body: The message after the header.
+    event: The name of the event triggered by this line, None if only 'any' applies.
+    match: The match of the event's body regex (contains a 'player' group for join, leave and chat).
+    seq: The sequence number assigned by the EventBus when published (increases by 1 per published record).
+
+    If the line has no valid header (e.g. a stacktrace), only line is set.
+    '''
+    __slots__ = ('line', 'date', 'time', 'thread', 'level', 'body', 'event', 'match', 'seq')
+
+    def __init__(self, line, date=None, time=None, thread=None, level=None, body=None, event=None, match=None):
+        self.line = line
+        self.date = date
+        self.time = time
+        self.thread = thread
+        self.level = level
+        self.body = body
+        self.event = event
+        self.match = match
+        self.seq = None
+
+    @property
+    def player(self):
+        '''
+        The player name for join, leave and chat events, else None.
+        '''
+        if self.match is None or 'player' not in self.match.re.groupindex:
+            return None
+        return self.match.group('player')
+
+    def __repr__(self):
+        return 'LogRecord(%r, event=%r)' % (self.line, self.event)
+
+
+startup_units = {'ns': 1e-9, 'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600}
+
+def startup_seconds(record):
+    '''
+    Returns the startup time in seconds reported by the server in a done record, None if it can't be read.
+    '''
+    if record.event != 'done' or record.match is None:
+        return None
+    unit = startup_units.get(record.match.group('unit'))
+    try:
+        return float(record.match.group('startup')) * unit
+    except (TypeError, ValueError):
+        return None
+
+
+def lag_ms(record):
+    '''
+    Returns how many milliseconds the server fell behind in a lag record, 0 if it didn't say (old versions).
+    '''
+    if record.event != 'lag' or record.match is None or record.match.group('ms') is None:
+        return 0
+    return int(record.match.group('ms'))
+
+
+class LagTracker:
+    '''
+    Rolling statistics of the lag spikes of the server: the amount of spikes, the total milliseconds the server fell
+    behind and the worst spike, per window of window seconds. Only windows with spikes are kept, for history seconds.
+    '''
+
+    def __init__(self, window=60, history=3600):
+        self.window = window
+        self.history = history
+        self.windows = deque() # [start, spikes, total ms, worst ms], oldest first.
+        self.last = None # time.time() of the last spike, None if there was none.
+        self.lock = Lock()
+
+    def add(self, ms, when=None):
+        '''
+        Adds a spike of ms milliseconds at time when (time.time() by default).
+        '''
+        when = time.time() if when is None else when
+        start = when - when % self.window
+        with self.lock:
+            while len(self.windows) > 0 and self.windows[0][0] <= when - self.history:
+                self.windows.popleft()
+            if len(self.windows) == 0 or self.windows[-1][0] != start:
+                self.windows.append([start, 0, 0, 0])
+            w = self.windows[-1]
+            w[1] += 1
+            w[2] += ms
+            w[3] = max(w[3], ms)
+            self.last = when
+
+    def recent(self, seconds):
+        '''
+        Returns copies of the windows with spikes in the last seconds (by window, so a bit more), oldest first.
+        '''
+        since = time.time() - seconds
+        with self.lock:
+            return [list(w) for w in self.windows if w[0] + self.window > since]
+
+    def stats(self, seconds):
+        '''
+        Returns the (spikes, total ms, worst ms) of the windows in the last seconds.
+        '''
+        windows = self.recent(seconds)
+        return sum(w[1] for w in windows), sum(w[2] for w in windows), max([w[3] for w in windows], default=0)
+
+    def overloaded(self, seconds=60):
+        '''
+        Returns True if the server had a lag spike in the last seconds.
+        '''
+        last = self.last
+        return last is not None and time.time() - last <= seconds
+
+
+class PlayerTracker:
+    '''
+    The players online, fed by the join and leave events. Cleared when the server is done starting (nobody is online
+    yet), and corrected with reconcile() by anyone who asked the server (e.g. with a status query).
+    '''
+
+    def __init__(self):
+        self.online = {} # name -> time.time() the player joined
+        self.unknown = 0 # Players the server reported, but whose names aren't known.
+        self.lock = Lock()
+
+    def join(self, name):
+        with self.lock:
+            self.online[name] = time.time()
+
+    def leave(self, name):
+        with self.lock:
+            if self.online.pop(name, None) is None and self.unknown > 0:
+                self.unknown -= 1
+
+    def clear(self):
+        with self.lock:
+            self.online.clear()
+            self.unknown = 0
+
+    def count(self):
+        '''
+        Returns the amount of players online.
+        '''
+        with self.lock:
+            return len(self.online) + self.unknown
+
+    def names(self):
+        '''
+        Returns the names of the players online (without the unknown ones), sorted.
+        '''
+        with self.lock:
+            return sorted(self.online)
+
+    def reconcile(self, count, names=[]):
+        '''
+        Corrects the players online with what the server reported: count players, of which at least names.
+        Returns True if the amount of players changed.
+        '''
+        now = time.time()
+        with self.lock:
+            old = len(self.online) + self.unknown
+            online = {name: self.online.get(name, now) for name in names}
+            for name, joined in self.online.items():
+                if name not in online and len(online) < count:
+                    online[name] = joined
+            self.online = online
+            self.unknown = max(0, count - len(online))
+            return old != count
+
+
+class EventDispatcher:
+
+    def __init__(self, use_legacy):
+        '''
+        use_legacy: Recognize the log format of legacy servers instead of the modern one.
+        '''
+        self.header = legacy_header if use_legacy else header
+        self.signatures = legacy_signatures if use_legacy else signatures
+
+    def parse(self, line):
+        '''
+        Returns the LogRecord of the line.
+        '''
+        h = self.header.match(line)
+        if h is None:
+            return LogRecord(line)
+        g = h.groupdict()
+        body = g['body']
+        for name, literal, at_start, pattern in self.signatures:
+            if body.startswith(literal) if at_start else literal in body:
+                m = pattern.match(body)
+                if m:
+                    return LogRecord(line, g.get('date'), g['time'], g.get('thread'), g['level'], body, name, m)
+        return LogRecord(line, g.get('date'), g['time'], g.get('thread'), g['level'], body)
+
+
+class Subscription:
+    '''
+    Receives the records of one or more events in order, through its own bounded queue.
+    With a callback, records are delivered on the worker pool of the bus (one at a time per subscription).
+    The callback may be an async def function, it then runs on the event loop of the bus (if any).
+    Without a callback, records are taken from the queue with get().
+    If the queue is full, the oldest record is dropped and counted in dropped (a gap in the seq numbers).
+    '''
+
+    def __init__(self, bus, names, callback, maxsize):
+        self.bus = bus
+        self.names = names
+        self.callback = callback
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.closed = False
+        self.queue = deque()
+        self.scheduled = False
+        self.condition = Condition(Lock())
+
+    def push(self, record):
+        with self.condition:
+            if self.closed:
+                return
+            if len(self.queue) >= self.maxsize:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(record)
+            if self.callback is None:
+                self.condition.notify()
+            elif not self.scheduled:
+                self.scheduled = True
+                self.bus.executor.submit(self.drain)
+
+    def drain(self):
+        while True:
+            with self.condition:
+                if self.closed or len(self.queue) == 0:
+                    self.scheduled = False
+                    return
+                record = self.queue.popleft()
+            try:
+                pu.run_awaitable(self.callback(record), self.bus.loop)
+            except Exception as e:
+                print('[PyCraft/ERROR] Event callback for %s failed: %s' % (', '.join(self.names), e))
+
+    def get(self, timeout=None):
+        '''
+        Returns the next record, or None when the timeout passed or the subscription was closed.
+        '''
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or len(self.queue) > 0, timeout)
+            if self.closed or len(self.queue) == 0:
+                return None
+            return self.queue.popleft()
+
+    def close(self):
+        '''
+        Unsubscribes and wakes up anyone waiting in get().
+        '''
+        self.bus.unsubscribe(self)
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.condition.notify_all()
+
+
+class EventBus:
+    '''
+    Publishes LogRecords to the subscribers of their event (and of 'any').
+    Subscribing happens at any time from any thread, no event is lost between two deliveries.
+    '''
+
+    def __init__(self, workers=4, queue_size=1024):
+        '''
+        workers: Amount of threads delivering records to callbacks.
+        queue_size: Default bound of the queue of a subscription.
+        '''
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pycraft-events')
+        self.subscriptions = {name: [] for name in event_names}
+        self.lock = Lock()
+        self.seq = 0
+        self.loop = None # The event loop running async callbacks (set by the asyncio core).
+        self.lag = LagTracker() # Fed by the published lag records.
+        self.players = PlayerTracker() # Fed by the published join, leave and done records.
+
+    def subscribe(self, names, callback=None, maxsize=None):
+        '''
+        names: An event name or list of event names.
+        callback: Function taking a LogRecord, or None to use Subscription.get().
+        maxsize: The bound of the queue of this subscription.
+        '''
+        if isinstance(names, str):
+            names = [names]
+        for name in names:
+            if name not in self.subscriptions:
+                raise Exception('Unknown event: %s' % name)
+        sub = Subscription(self, names, callback, maxsize or self.queue_size)
+        with self.lock:
+            for name in names:
+                # Copy on write, so publish can iterate without holding the lock.
+                self.subscriptions[name] = self.subscriptions[name] + [sub]
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            for name in sub.names:
+                self.subscriptions[name] = [s for s in self.subscriptions[name] if s is not sub]
+
+    def publish(self, record):
+        '''
+        Delivers the record to the subscribers of its event and of 'any'. Records without a header are not published.
+        '''
+        if record.body is None:
+            return
+        self.seq += 1
+        record.seq = self.seq
+        if record.event == 'lag':
+            self.lag.add(lag_ms(record))
+        elif record.event == 'join':
+            self.players.join(record.player)
+        elif record.event == 'leave':
+            self.players.leave(record.player)
+        elif record.event == 'done':
+            self.players.clear()
+        subs = self.subscriptions['any']
+        if record.event is not None:
+            subs = self.subscriptions[record.event] + [s for s in subs if s not in self.subscriptions[record.event]]
+        for sub in subs:
+            sub.push(record)
+
+    def close(self):
+        '''
+        Closes all subscriptions and waits for running callbacks to finish.
+        '''
+        with self.lock:
+            subs = set(s for name in self.subscriptions for s in self.subscriptions[name])
+        for sub in subs:
+            sub.close()
+        self.executor.shutdown(wait=True)
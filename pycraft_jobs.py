@@ -0,0 +1,138 @@
+'''
+Runs module commands on a pool of threads, so a long command (e.g. backup now) doesn't block the console.
+
+Every module has a concurrency limit (PCMod.max_concurrency, 1 by default). Commands for a module which is at its
+limit wait in a bounded queue and run in the order they were given.
+'''
+
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from collections import deque
+from threading import Lock
+
+
+class Job:
+
+    def __init__(self, job_id, module, command, fn):
+        self.id = job_id
+        self.module = module
+        self.command = command
+        self.fn = fn
+        self.submitted = time.time()
+        self.started = None # Time the job started running, None while queued.
+        self.future = None # Set when handed to the pool.
+
+    def elapsed(self):
+        '''
+        Returns the time in seconds the job has been running (or queued if it hasn't started yet).
+        '''
+        return time.time() - (self.submitted if self.started is None else self.started)
+
+
+class JobRunner:
+
+    def __init__(self, workers=8, max_waiting=16):
+        '''
+        workers: Amount of threads running commands.
+        max_waiting: Max amount of commands waiting per module, further commands are rejected.
+        '''
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pycraft-jobs')
+        self.max_waiting = max_waiting
+        self.lock = Lock()
+        self.jobs = [] # All queued and running jobs, oldest first.
+        self.waiting = {} # module -> jobs waiting for the concurrency limit of the module.
+        self.limits = {} # module -> concurrency limit
+        self.active = {} # module -> amount of jobs handed to the pool
+        self.next_id = 1
+        self.closed = False
+
+    def submit(self, module, command, fn, limit=1):
+        '''
+        Runs fn on the pool, or queues it when module already runs limit commands.
+        Raises an Exception if the command was rejected.
+        '''
+        with self.lock:
+            if self.closed:
+                raise Exception('Commands are no longer accepted.')
+            waiting = self.waiting.setdefault(module, deque())
+            if len(waiting) >= self.max_waiting:
+                raise Exception('Too many commands waiting for %s.' % module)
+            job = Job(self.next_id, module, command, fn)
+            self.next_id += 1
+            self.jobs.append(job)
+            self.limits[module] = limit
+            if self.active.get(module, 0) < limit:
+                self.start(job)
+            else:
+                waiting.append(job)
+            return job
+
+    def start(self, job):
+        # Lock must be held.
+        self.active[job.module] = self.active.get(job.module, 0) + 1
+        job.future = self.executor.submit(self.run, job)
+
+    def run(self, job):
+        job.started = time.time()
+        try:
+            job.fn()
+        finally:
+            with self.lock:
+                self.finish(job)
+
+    def finish(self, job):
+        # Lock must be held.
+        self.jobs.remove(job)
+        self.active[job.module] -= 1
+        waiting = self.waiting.get(job.module)
+        if waiting and not self.closed and self.active[job.module] < self.limits[job.module]:
+            self.start(waiting.popleft())
+
+    def cancel(self, module=None):
+        '''
+        Cancels all commands (of module, or of all modules if None) that haven't started yet.
+        Running commands can't be interrupted, they should return when the module is closed.
+        Returns the amount of cancelled commands.
+        '''
+        cancelled = 0
+        with self.lock:
+            for m, waiting in self.waiting.items():
+                if module is None or m == module:
+                    for job in waiting:
+                        self.jobs.remove(job)
+                    cancelled += len(waiting)
+                    waiting.clear()
+            for job in list(self.jobs):
+                if (module is None or job.module == module) and job.future.cancel():
+                    self.jobs.remove(job)
+                    self.active[job.module] -= 1
+                    cancelled += 1
+        return cancelled
+
+    def wait(self, module=None, timeout=None):
+        '''
+        Waits for the running commands (of module, or of all modules if None).
+        Returns the jobs still running after the timeout.
+        '''
+        with self.lock:
+            futures = {job.future: job for job in self.jobs if job.future is not None and (module is None or job.module == module)}
+        not_done = wait(futures, timeout).not_done
+        return [futures[f] for f in not_done]
+
+    def list(self):
+        '''
+        Returns a copy of all queued and running jobs, oldest first.
+        '''
+        with self.lock:
+            return list(self.jobs)
+
+    def close(self):
+        '''
+        Stops accepting commands and cancels those that haven't started yet.
+        '''
+        with self.lock:
+            self.closed = True
+        self.cancel()
+        self.executor.shutdown(wait=False)
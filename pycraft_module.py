@@ -3,11 +3,14 @@ A PyCraft module is basically a custom console command that allows to interact w
 Some basic modules have been added already to serve as an example and also because they're very generic and useful.
 
 You can create your own by very easily and modules can be hotfixed dynamically, removed, added, etc.
+Every server gets its own instance of a module, so module globals are never shared between servers.
 
 To create a PyCraft Server Module, you need:
  - get_module(): Should return a PCMod object.
 '''
 
+import bisect
+
 severities = ['DEBUG', 'INFO', 'WARN', 'ERROR']
 
 # From most to least ERROR, WARN, INFO, DEBUG. setting the least significant to 0, disables debug warning.
@@ -15,14 +18,22 @@ log_flag = 0b1110
 
 class PCMod:
 
-    def __init__(self, name, description, patterns, callback, close_callback, help_callback=lambda _: 'No help specified.'):
+    def __init__(self, name, description, patterns, callback, close_callback, help_callback=lambda _: 'No help specified.', max_concurrency=1, state_callback=None, restore_callback=None):
         '''
         name: Should be __name__
         description: Human readable description.
         patterns: The patterns on which to match this command.
         callback: The function to call when matched on pattern. Takes all subcommands, server_config and stdin as arguments.
+            May be an async def function, it then runs on the event loop (of the asyncio core, or a new one).
         help_callback: The function to call when help <name> is ran. Takes all subcommands as argument.
         close_callback: Function run when the server is closed. Use this to join threads, close resources and cleanup.
+            It must also make running callbacks return, they run on a separate thread.
+        max_concurrency: Max amount of commands of this module running at the same time, others wait for their turn.
+            Only raise this if the callback is safe to run concurrently.
+        state_callback: Function run before the module is closed for a reload. Returns the state (e.g. schedules, toggles)
+            to hand over to the reloaded version of the module.
+        restore_callback: Function run on the reloaded version of the module with the state returned by state_callback of
+            the old version. Takes the state, server_config, stdin and the event_bus as arguments.
         '''
         self.name = name
         self.description = description
@@ -30,6 +41,11 @@ class PCMod:
         self.callback = callback
         self.help_callback = help_callback
         self.close = close_callback if not (close_callback is None) else lambda: None
+        self.max_concurrency = max_concurrency
+        self.state_callback = state_callback
+        self.restore_callback = restore_callback
+        self.prefix = '' # Set by PyCraft to tell servers apart when it runs more than one.
+        self.scheduler = None # Set by PyCraft: the Scheduler of the server (see pycraft_scheduler).
 
     def matches(self, cmd):
         '''
@@ -40,21 +56,53 @@ class PCMod:
                 return True
         return False
 
-    def execute(self, subcmd, server_config, writeline_to_console, event_triggers):
+    def execute(self, subcmd, server_config, writeline_to_console, event_bus):
         '''
         subcmd: The remaining subcommands after the matched pattern.
         server_config: The server config specific to this server, including port, name, etc.
         writeline_to_console: Function to write utf8 to server console, which allows writing commands to it such as say, stop, etc.
-        event_triggers: Dict of events that can be triggered (see pycraft_server for a list of them).
+        event_bus: The EventBus to subscribe to server events (see pycraft_events for a list of them).
+        Returns what the callback returns (a coroutine for async callbacks).
         '''
-        self.callback(subcmd, server_config, writeline_to_console, event_triggers)
+        return self.callback(subcmd, server_config, writeline_to_console, event_bus)
+
+    def get_state(self):
+        '''
+        Returns the state to hand over to the reloaded version of this module, None if there is none.
+        '''
+        return None if self.state_callback is None else self.state_callback()
+
+    def set_state(self, state, server_config, writeline_to_console, event_bus):
+        '''
+        Restores the state handed over by the previous version of this module.
+        '''
+        if self.restore_callback is not None and state is not None:
+            self.restore_callback(state, server_config, writeline_to_console, event_bus)
+
+    def schedule_once(self, delay, fn, name):
+        '''
+        Runs fn once after delay seconds, see Scheduler.once. The jobs of a module are cancelled when it is closed.
+        '''
+        return self.scheduler.once(delay, fn, name, self.name)
+
+    def schedule_every(self, interval, fn, name, first=None):
+        '''
+        Runs fn every interval seconds (without drifting), see Scheduler.every.
+        '''
+        return self.scheduler.every(interval, fn, name, self.name, first)
+
+    def schedule_cron(self, spec, fn, name):
+        '''
+        Runs fn at the times matching the cron-style spec (e.g. "0 4 * * *" for 4 AM daily), see Scheduler.cron.
+        '''
+        return self.scheduler.cron(spec, fn, name, self.name)
 
     def pyprint(self, string, loglevel=1):
         '''
         Prints with a convenient loglevel and format.
         '''
         if ((2 ** loglevel) & log_flag) != 0:
-            print("[PyCraft.%s/%s] %s" % (self.name, severities[loglevel], string))
+            print("%s[PyCraft.%s/%s] %s" % (self.prefix, self.name, severities[loglevel], string))
 
     def help(self, subcmd):
         '''
@@ -62,3 +110,72 @@ class PCMod:
         '''
         self.pyprint(self.help_callback(subcmd))
 
+
+class CommandRegistry:
+    '''
+    Maps the patterns of all modules to their module, so a command is found with a single lookup.
+    '''
+
+    def __init__(self, reserved=()):
+        '''
+        reserved: Command names that modules can't use (the built-in commands).
+        '''
+        self.reserved = set(reserved)
+        self.commands = {}
+        self.aliases = {}
+        self.names = None # Sorted patterns for prefix lookups, built on first use.
+
+    def register(self, module):
+        '''
+        Adds the patterns of the module. Patterns already in use are skipped.
+        Returns a list of warnings for those patterns.
+        '''
+        conflicts = []
+        for p in module.patterns:
+            if p in self.reserved:
+                conflicts.append('Pattern "%s" of %s is a built-in command and is ignored.' % (p, module.name))
+            elif p in self.commands and self.commands[p] is not module:
+                conflicts.append('Pattern "%s" of %s is already used by %s and is ignored.' % (p, module.name, self.commands[p].name))
+            else:
+                self.commands[p] = module
+        self.names = None
+        return conflicts
+
+    def unregister(self, module):
+        '''
+        Removes all patterns of the module.
+        '''
+        self.commands = {p: m for p, m in self.commands.items() if m is not module}
+        self.names = None
+
+    def clear(self):
+        self.commands = {}
+        self.names = None
+
+    def expand(self, cmd_parts):
+        '''
+        Replaces the first word with its alias (a command, possibly with subcommands), if any.
+        Aliases are expanded once, so they can't loop.
+        '''
+        if len(cmd_parts) > 0 and cmd_parts[0] in self.aliases:
+            return self.aliases[cmd_parts[0]].split() + cmd_parts[1:]
+        return cmd_parts
+
+    def lookup(self, key):
+        '''
+        Returns the module of the pattern key, or of the only module with a pattern starting with key.
+        Returns None if there is none, raises an Exception if the prefix matches multiple modules.
+        '''
+        m = self.commands.get(key)
+        if m is not None or key is None:
+            return m
+        if self.names is None:
+            self.names = sorted(self.commands)
+        i = bisect.bisect_left(self.names, key)
+        found = {}
+        while i < len(self.names) and self.names[i].startswith(key):
+            found.setdefault(self.commands[self.names[i]], self.names[i])
+            i += 1
+        if len(found) > 1:
+            raise Exception('Ambiguous command "%s", did you mean: %s?' % (key, ', '.join(found.values())))
+        return next(iter(found), None)
@@ -0,0 +1,68 @@
+'''
+Reads and writes Anvil region files (.mca), which hold up to 32x32 chunks.
+
+A region file starts with two tables of 1024 big-endian 4 byte entries, one per chunk (index x + 32 * z within the
+region): the locations (first sector << 8 | sector count, in 4 KiB sectors) and the timestamps of the last time the
+chunk was saved. A chunk is stored as a record: its length (4 bytes), its compression type (1 byte) and its data, padded
+to whole sectors.
+'''
+
+import struct
+
+sector = 4096
+header_size = 2 * sector
+uncompressed = 3 # The compression type of chunks stored as is.
+
+
+def read_header(data):
+    '''
+    Returns (locations, timestamps) of the region file data (e.g. an mmap of the file). The locations are (first
+    sector, sector count) tuples, (0, 0) for a missing chunk. Returns None if data isn't a valid region file.
+    '''
+    if len(data) < header_size:
+        return None
+    sectors = -(-len(data) // sector)
+    locations = [(e >> 8, e & 0xFF) for e in struct.unpack_from('>1024I', data, 0)]
+    for offset, count in locations:
+        if offset != 0 and (offset < 2 or count == 0 or offset + count > sectors):
+            return None
+    return locations, list(struct.unpack_from('>1024I', data, sector))
+
+
+def read_record(data, offset, count):
+    '''
+    Returns the record of the chunk at the given location (without padding), None if it's invalid.
+    '''
+    start = offset * sector
+    if start + 5 > len(data):
+        return None
+    length = struct.unpack_from('>I', data, start)[0]
+    if length == 0 or 4 + length > count * sector or start + 4 + length > len(data):
+        return None
+    return data[start:start + 4 + length]
+
+
+def is_compressed(record):
+    return record[4] & 0x7F != uncompressed
+
+
+def write(file, chunks):
+    '''
+    Writes a region file of chunks: (index, timestamp, record) tuples. The chunks are laid out in the given order.
+    '''
+    locations = [0] * 1024
+    timestamps = [0] * 1024
+    next_sector = 2
+    for index, timestamp, record in chunks:
+        count = -(-len(record) // sector)
+        if count > 0xFF:
+            raise Exception('Chunk %d is too large for a region file.' % index)
+        locations[index] = (next_sector << 8) | count
+        timestamps[index] = timestamp
+        next_sector += count
+    with open(file, 'wb') as f:
+        f.write(struct.pack('>1024I', *locations))
+        f.write(struct.pack('>1024I', *timestamps))
+        for _, _, record in chunks:
+            f.write(record)
+            f.write(bytes(-len(record) % sector))
@@ -0,0 +1,256 @@
+'''
+Runs the timed jobs of the modules (e.g. automatic backups, the shutdown countdown) from a single thread.
+
+The jobs are kept in a heap ordered by the time they are due, the thread sleeps until the first one is. A due job is
+handed to a small pool of threads, so a long job (a backup) doesn't delay the others. Repeating jobs are planned from
+the time they were due instead of the time they ran, so they don't drift.
+'''
+
+import pycraft_utils as pu
+import heapq
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+from threading import Condition
+from threading import Lock
+from threading import Thread
+
+
+class Cron:
+    '''
+    A cron-style schedule: "minute hour day month weekday" (local time). Every field is *, a number, a range (1-5),
+    a list (0,30) or a step (*/15, 8-18/2). Weekday 0 (or 7) is Sunday.
+    Like cron, if both the day and the weekday are restricted, a time matching either of them fires.
+    '''
+    ranges = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, spec):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise Exception('A cron schedule has 5 fields (minute hour day month weekday): %s' % spec)
+        self.spec = spec
+        self.minutes, self.hours, self.days, self.months, weekdays = [Cron.parse(f, lo, hi) for f, (lo, hi) in zip(fields, Cron.ranges)]
+        self.weekdays = set(d % 7 for d in weekdays)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def parse(field, lo, hi):
+        values = set()
+        for part in field.split(','):
+            first, _, step = part.partition('/')
+            try:
+                if first == '*':
+                    a, b = lo, hi
+                elif '-' in first:
+                    a, b = [int(x) for x in first.split('-', 1)]
+                else:
+                    a = int(first)
+                    b = hi if step else a # 5/15 means 5, 20, 35, ...
+                step = int(step) if step else 1
+            except ValueError:
+                raise Exception('Invalid cron field: %s' % field)
+            if a < lo or b > hi or a > b or step < 1:
+                raise Exception('Invalid cron field: %s (must be within %d-%d)' % (field, lo, hi))
+            values.update(range(a, b + 1, step))
+        return values
+
+    def day_matches(self, d):
+        day = d.day in self.days
+        weekday = d.isoweekday() % 7 in self.weekdays
+        if self.any_day:
+            return weekday
+        if self.any_weekday:
+            return day
+        return day or weekday
+
+    def next(self, after):
+        '''
+        Returns the first time (as time.time()) after the given time that matches the schedule.
+        '''
+        d = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = d + timedelta(days=366 * 4) # Long enough for the 29th of February.
+        while d < limit:
+            if d.month not in self.months:
+                d = (d.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self.day_matches(d):
+                d = d.replace(hour=0, minute=0) + timedelta(days=1)
+            elif d.hour not in self.hours:
+                d = d.replace(minute=0) + timedelta(hours=1)
+            elif d.minute not in self.minutes:
+                d += timedelta(minutes=1)
+            else:
+                return d.timestamp()
+        raise Exception('The cron schedule never fires: %s' % self.spec)
+
+
+class ScheduledJob:
+
+    def __init__(self, scheduler, job_id, name, owner, fn, due, interval=None, cron=None):
+        self.scheduler = scheduler
+        self.id = job_id
+        self.name = name
+        self.owner = owner # E.g. the name of the module, to cancel all its jobs at once.
+        self.fn = fn
+        self.due = due # time.time() the job fires next, None when a one-shot job has fired.
+        self.interval = interval # Seconds between the runs of a fixed-rate job.
+        self.cron = cron # The Cron of a cron-style job.
+        self.cancelled = False
+        self.running = False
+        self.runs = 0
+        self.skipped = 0 # Runs skipped because the previous run was still busy, or the scheduler fell behind.
+
+    def kind(self):
+        '''
+        Returns a short description of when the job fires.
+        '''
+        if self.interval is not None:
+            return 'every %gs' % self.interval
+        if self.cron is not None:
+            return 'cron "%s"' % self.cron.spec
+        return 'once'
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+
+class Scheduler:
+    '''
+    Fires one-shot, fixed-rate and cron-style jobs. Job functions may be async def functions, they then run on the
+    event loop of the scheduler (if any). The thread is only started when the first job is added.
+    '''
+
+    def __init__(self, workers=4):
+        '''
+        workers: Amount of threads running the due jobs.
+        '''
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pycraft-scheduler')
+        self.condition = Condition(Lock())
+        self.heap = [] # (due, id, job), the cancelled jobs are removed when they reach the top.
+        self.next_id = 1
+        self.thread = None
+        self.closed = False
+        self.loop = None # The event loop running async jobs (set by the asyncio core).
+
+    def once(self, delay, fn, name, owner=None):
+        '''
+        Runs fn once, after delay seconds.
+        '''
+        return self.add(name, owner, fn, time.time() + max(0, delay))
+
+    def every(self, interval, fn, name, owner=None, first=None):
+        '''
+        Runs fn every interval seconds, the first time after first seconds (interval by default).
+        A run is skipped if the previous one is still busy.
+        '''
+        if interval <= 0:
+            raise Exception('The interval must be positive.')
+        return self.add(name, owner, fn, time.time() + (interval if first is None else max(0, first)), interval=interval)
+
+    def cron(self, spec, fn, name, owner=None):
+        '''
+        Runs fn at the times matching the cron-style spec (see Cron).
+        '''
+        cron = Cron(spec)
+        return self.add(name, owner, fn, cron.next(time.time()), cron=cron)
+
+    def add(self, name, owner, fn, due, interval=None, cron=None):
+        with self.condition:
+            if self.closed:
+                raise Exception('Jobs are no longer accepted.')
+            job = ScheduledJob(self, self.next_id, name, owner, fn, due, interval, cron)
+            self.next_id += 1
+            heapq.heappush(self.heap, (due, job.id, job))
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name='pycraft-scheduler', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+            return job
+
+    def cancel(self, job):
+        '''
+        Cancels the job, a run that already started isn't interrupted.
+        '''
+        with self.condition:
+            job.cancelled = True
+
+    def cancel_owner(self, owner):
+        '''
+        Cancels all jobs of owner, returns the amount of cancelled jobs.
+        '''
+        cancelled = 0
+        with self.condition:
+            for _, _, job in self.heap:
+                if job.owner == owner and not job.cancelled:
+                    job.cancelled = True
+                    cancelled += 1
+        return cancelled
+
+    def list(self):
+        '''
+        Returns the pending jobs, the first due first.
+        '''
+        with self.condition:
+            return [job for _, _, job in sorted(self.heap) if not job.cancelled]
+
+    def run(self):
+        with self.condition:
+            while not self.closed:
+                while len(self.heap) > 0 and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                if len(self.heap) == 0:
+                    self.condition.wait()
+                    continue
+                now = time.time()
+                if self.heap[0][0] > now:
+                    self.condition.wait(self.heap[0][0] - now)
+                    continue
+                self.fire(heapq.heappop(self.heap)[2], now)
+
+    def fire(self, job, now):
+        # Lock must be held.
+        if job.running:
+            job.skipped += 1
+        else:
+            job.running = True
+            self.executor.submit(self.execute, job)
+
+        if job.interval is not None:
+            due = job.due + job.interval # From when it was due, so it doesn't drift.
+            if due <= now:
+                # Fell behind (e.g. the computer was asleep), skip the runs that were missed.
+                missed = int((now - due) // job.interval) + 1
+                job.skipped += missed
+                due += missed * job.interval
+        elif job.cron is not None:
+            due = job.cron.next(max(job.due, now))
+        else:
+            job.due = None
+            return
+        job.due = due
+        heapq.heappush(self.heap, (due, job.id, job))
+
+    def execute(self, job):
+        try:
+            pu.run_awaitable(job.fn(), self.loop)
+        except Exception as e:
+            print('[PyCraft/ERROR] Scheduled job %s failed: %s' % (job.name, e))
+        finally:
+            with self.condition:
+                job.running = False
+                job.runs += 1
+
+    def close(self):
+        '''
+        Cancels all jobs and stops the thread. Running jobs are not waited for, they should return when their module is
+        closed.
+        '''
+        with self.condition:
+            self.closed = True
+            for _, _, job in self.heap:
+                job.cancelled = True
+            self.heap.clear()
+            self.condition.notify()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,264 @@
+'''
+A content-addressed backup store. Every file is saved once, as a compressed object named after the sha256 of its
+content. A snapshot is a manifest (json) listing the object of every file, so files with the same content share an
+object. Files that didn't change since the previous snapshot (same size and modification time) are neither read nor
+compressed again, they cost nothing but their line in the manifest.
+
+Region files can be stored per chunk instead: a chunk whose timestamp and length didn't change since the previous
+snapshot isn't read again, and only new chunk payloads are added to the store. On restore, full region files are rebuilt
+from the chunks (with the same chunks, but not necessarily the same bytes as the original file).
+
+Objects are stored under <store>/objects/<first 2 digits of the hash>/<hash>. Objects that no manifest refers to anymore
+(because the snapshots were deleted) are removed by gc.
+'''
+
+import hashlib
+import json
+import os
+import time
+import zlib
+
+import pycraft_region as pr
+
+manifest_version = 1
+
+
+def object_path(store, sha):
+    return os.path.join(store, 'objects', sha[:2], sha)
+
+
+def hash_file(file):
+    h = hashlib.sha256()
+    with open(file, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_object(store, sha, data, level):
+    '''
+    Stores data (bytes, or an iterable of bytes) as the object sha, unless it exists already.
+    Returns the amount of bytes written.
+    '''
+    dst = object_path(store, sha)
+    if os.path.exists(dst):
+        return 0
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    compressor = zlib.compressobj(level)
+    written = 0
+    tmp = '%s.%d.tmp' % (dst, os.getpid())
+    with open(tmp, 'wb') as out:
+        for chunk in [data] if isinstance(data, bytes) else data:
+            c = compressor.compress(chunk)
+            out.write(c)
+            written += len(c)
+        c = compressor.flush()
+        out.write(c)
+        written += len(c)
+    os.replace(tmp, dst) # Never leaves a partial object behind.
+    return written
+
+
+def read_chunks(file):
+    with open(file, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            yield chunk
+
+
+def read_object(store, sha):
+    with open(object_path(store, sha), 'rb') as f:
+        return zlib.decompress(f.read())
+
+
+def store_file(store, file, level):
+    '''
+    Adds the file to the store, returns (sha256, bytes written). Runs in the process pool of snapshot.
+    '''
+    sha = hash_file(file)
+    return sha, write_object(store, sha, read_chunks(file), level)
+
+
+def store_region(store, file, level, old_chunks):
+    '''
+    Adds the chunks of the region file to the store, returns ({'chunks': [[index, timestamp, length, sha256], ...]},
+    bytes written), or None if it isn't a valid region file.
+    old_chunks: {index: [index, timestamp, length, sha256]} of the previous snapshot of the file.
+    '''
+    import mmap
+    with open(file, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # Empty file.
+            return None
+    with data:
+        header = pr.read_header(data)
+        if header is None:
+            return None
+        chunks = []
+        written = 0
+        for index, ((offset, count), timestamp) in enumerate(zip(*header)):
+            if offset == 0:
+                continue
+            length = int.from_bytes(data[offset * pr.sector:offset * pr.sector + 4], 'big')
+            old = old_chunks.get(index)
+            if old is not None and old[1] == timestamp and old[2] == length:
+                chunks.append(old) # Not saved since, the payload is the same.
+                continue
+            record = pr.read_record(data, offset, count)
+            if record is None:
+                return None
+            sha = hashlib.sha256(record).hexdigest()
+            # Chunks are compressed already, compressing them again takes time and gains little.
+            written += write_object(store, sha, record, 0 if pr.is_compressed(record) else level)
+            chunks.append([index, timestamp, length, sha])
+    return {'chunks': chunks}, written
+
+
+def store_entry(store, file, level, old_chunks=None):
+    '''
+    Adds the file to the store, returns (manifest entry without size and mtime, bytes written). Runs in the process pool
+    of snapshot.
+    old_chunks: Stores the file per chunk if it's a valid region file, see store_region.
+    '''
+    if old_chunks is not None:
+        stored = store_region(store, file, level, old_chunks)
+        if stored is not None:
+            return stored
+    sha, written = store_file(store, file, level)
+    return {'sha': sha}, written
+
+
+def load(manifest_path):
+    with open(manifest_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save(manifest, manifest_path):
+    tmp = manifest_path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(tmp, manifest_path)
+
+
+def pool_map(fn, args, workers):
+    '''
+    Maps fn over the argument tuples, in a (spawned) pool of workers processes if workers > 1.
+    '''
+    if workers <= 1 or len(args) == 0:
+        return [fn(*a) for a in args]
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+    # Spawn (not fork) as the console threads hold locks (e.g. of stdin) which would deadlock a forked child.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+        return list(pool.map(fn, *zip(*args), chunksize=max(1, len(args) // (workers * 8))))
+
+
+class SnapshotStats:
+
+    def __init__(self):
+        self.files = 0 # Files in the snapshot.
+        self.size = 0 # Their total size.
+        self.changed_files = 0 # Files that were read (new or changed since the previous snapshot).
+        self.changed_size = 0 # Their total size.
+        self.written = 0 # Bytes added to the store.
+        self.changed_chunks = 0 # Chunks of region files that are new or changed since the previous snapshot.
+
+
+def snapshot(folder, store, manifest_path, previous=None, skip=[], workers=1, level=6, chunks=False):
+    '''
+    Adds the files of folder (except the file names in skip) to the store and writes the manifest of the snapshot to
+    manifest_path. Returns the SnapshotStats.
+    previous: The manifest of the previous snapshot, its unchanged files are taken over without reading them.
+    chunks: Store region files per chunk.
+    '''
+    old = previous['files'] if previous is not None else {}
+    stats = SnapshotStats()
+    files = {}
+    todo = []
+    for root, dirs, names in os.walk(folder):
+        dirs.sort()
+        for name in sorted(names):
+            if name in skip:
+                continue
+            file = os.path.join(root, name)
+            rel = os.path.relpath(file, folder).replace(os.sep, '/')
+            st = os.stat(file)
+            stats.files += 1
+            stats.size += st.st_size
+            entry = old.get(rel)
+            if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns and ('sha' not in entry or os.path.exists(object_path(store, entry['sha']))):
+                files[rel] = entry
+            elif chunks and name.endswith('.mca'):
+                todo.append((rel, file, st, {c[0]: c for c in entry.get('chunks', [])} if entry is not None else {}))
+            else:
+                todo.append((rel, file, st, None))
+
+    results = pool_map(store_entry, [(store, file, level, old_chunks) for _, file, _, old_chunks in todo], workers)
+    for (rel, _, st, old_chunks), (stored, written) in zip(todo, results):
+        files[rel] = dict(stored, size=st.st_size, mtime=st.st_mtime_ns)
+        stats.changed_files += 1
+        stats.changed_size += st.st_size
+        stats.written += written
+        if 'chunks' in stored:
+            stats.changed_chunks += sum(1 for c in stored['chunks'] if old_chunks.get(c[0]) != c)
+
+    save({'version': manifest_version, 'created': time.time(), 'files': dict(sorted(files.items()))}, manifest_path)
+    return stats
+
+
+def restore(store, manifest, target):
+    '''
+    Rebuilds the files of the snapshot under the folder target. Returns the amount of files.
+    '''
+    for rel, entry in manifest['files'].items():
+        file = os.path.join(target, *rel.split('/'))
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        if 'chunks' in entry:
+            pr.write(file, [(index, timestamp, read_object(store, sha)) for index, timestamp, _, sha in entry['chunks']])
+        else:
+            with open(file, 'wb') as f:
+                f.write(read_object(store, entry['sha']))
+        os.utime(file, ns=(entry['mtime'], entry['mtime']))
+    return len(manifest['files'])
+
+
+def references(manifest):
+    '''
+    Returns the hashes of the objects the manifest refers to.
+    '''
+    used = set()
+    for entry in manifest['files'].values():
+        if 'chunks' in entry:
+            used.update(c[3] for c in entry['chunks'])
+        else:
+            used.add(entry['sha'])
+    return used
+
+
+def gc(store, manifest_paths):
+    '''
+    Removes the objects none of the manifests refer to. Must not run during a snapshot.
+    Returns (removed objects, freed bytes).
+    '''
+    used = set()
+    for manifest_path in manifest_paths:
+        used |= references(load(manifest_path))
+    removed = 0
+    freed = 0
+    objects = os.path.join(store, 'objects')
+    if not os.path.isdir(objects):
+        return removed, freed
+    for prefix in os.listdir(objects):
+        for name in os.listdir(os.path.join(objects, prefix)):
+            if name not in used: # Also removes the partial objects of an interrupted snapshot.
+                file = os.path.join(objects, prefix, name)
+                freed += os.path.getsize(file)
+                os.remove(file)
+                removed += 1
+    return removed, freed
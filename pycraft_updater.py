@@ -10,6 +10,7 @@ version_url = "https://launchermeta.mojang.com/mc/game/version_manifest.json"
 config_file = 'config.json'
 temp_download_folder = "__TEMP_UPDATE_JARS_b590aOih9"
 servers_folder = "servers"
+launch_plan_file = os.path.join(".pycraft", "launch_plan.json") # Cached by pycraft.py, depends on the server.jar.
 
 def get_latest():
 	with requests.get(version_url) as f:
@@ -37,6 +38,13 @@ def server_version_info(server_jar):
 	except:
 		return "OLD" # version.json doesn't exist
 
+def install_jar(jar, server):
+	shutil.copy(jar, os.path.join(os.path.join(servers_folder, server), "server.jar"))
+	try:
+		os.remove(os.path.join(os.path.join(servers_folder, server), launch_plan_file))
+	except FileNotFoundError:
+		pass
+
 def read_config():
 	try:
 		with open(config_file, 'r') as f:
@@ -88,8 +96,7 @@ def update(latest_release, latest_snapshot, release_servers, snapshot_servers, r
 			download_url(snapshot_jar_url, temp_snapshot_jar)
 			for server in snapshot_servers:
 				print(f"[PyCraftUpdater/INFO] Updating {server}...")
-				path = os.path.join(os.path.join(servers_folder, server), "server.jar")
-				shutil.copy(temp_snapshot_jar, path)
+				install_jar(temp_snapshot_jar, server)
 
 		if release_servers:
 			print(f"[PyCraftUpdater/INFO] Downloading latest release {latest_release}...")
@@ -102,8 +109,7 @@ def update(latest_release, latest_snapshot, release_servers, snapshot_servers, r
 			download_url(release_jar_url, temp_release_jar)
 			for server in release_servers:
 				print(f"[PyCraftUpdater/INFO] Updating {server}...")
-				path = os.path.join(os.path.join(servers_folder, server), "server.jar")
-				shutil.copy(temp_release_jar, path)
+				install_jar(temp_release_jar, server)
 
 		shutil.rmtree(temp_download_folder)
 
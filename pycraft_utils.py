@@ -1,3 +1,5 @@
+import os
+
 
 def parse_time(time_str, def_unit='s'):
     '''
@@ -35,4 +37,130 @@ def next_cmd(args):
     if (len(args) > 0):
         a, *b = args
         return (a, b)
-    return (None, [])
\ No newline at end of file
+    return (None, [])
+
+def run_awaitable(result, loop=None):
+    '''
+    If result is awaitable (e.g. returned by an async def callback), runs it to completion and returns its result.
+    Runs on loop (from another thread) if given, else on a new event loop.
+    '''
+    if result is None:
+        return result # Most callbacks return nothing, don't import asyncio for them.
+    import inspect
+    if not inspect.isawaitable(result):
+        return result
+    import asyncio
+    if loop is not None:
+        return asyncio.run_coroutine_threadsafe(result, loop).result()
+    async def wrapper():
+        return await result
+    return asyncio.run(wrapper())
+
+def deflate_file(file, level):
+    '''
+    Compresses the file to a raw deflate stream (the way a zip stores it), returns (crc32, size, compressed data).
+    Runs in the process pool of zip_folder.
+    '''
+    import zlib
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    parts = []
+    with open(file, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            parts.append(compressor.compress(chunk))
+    parts.append(compressor.flush())
+    return crc, size, b''.join(parts)
+
+def write_deflated(zipf, file, arcname, deflated):
+    '''
+    Adds the file compressed by deflate_file to zipf, returns its size.
+    '''
+    import zipfile
+    crc, size, data = deflated
+    info = zipfile.ZipInfo.from_file(file, arcname)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.CRC = crc
+    info.file_size = size
+    info.compress_size = len(data)
+    # ZipFile can't add compressed data, so the entry is written the way ZipFile.write does it.
+    info.header_offset = zipf.fp.tell()
+    zipf.fp.write(info.FileHeader())
+    zipf.fp.write(data)
+    zipf.filelist.append(info)
+    zipf.NameToInfo[info.filename] = info
+    zipf.start_dir = zipf.fp.tell()
+    zipf._didModify = True
+    return size
+
+def zip_folder(folder, zip_path, root_name, skip=[], workers=1, level=6):
+    '''
+    Zips all files in folder (except the file names in skip) to zip_path, under the folder root_name in the archive.
+    The files (e.g. every region file) are compressed in parallel by a pool of workers processes, the archive lists them
+    in sorted order, so the same world always gives the same archive. Returns the amount of bytes read.
+    level: The deflate compression level (0-9).
+    '''
+    import zipfile
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    files = []
+    for root, dirs, names in os.walk(folder):
+        dirs.sort()
+        rel = os.path.relpath(root, folder)
+        for name in sorted(names):
+            if name not in skip:
+                files.append((os.path.join(root, name), os.path.normpath(os.path.join(root_name, rel, name))))
+
+    total = 0
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        if workers <= 1: # zlib releases the GIL while compressing, a pool would only add copying.
+            for file, arcname in files:
+                total += write_deflated(zipf, file, arcname, deflate_file(file, level))
+            return total
+        # Spawn (not fork) as the console threads hold locks (e.g. of stdin) which would deadlock a forked child.
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+            pending = deque()
+            for file, arcname in files:
+                pending.append((file, arcname, pool.submit(deflate_file, file, level)))
+                if len(pending) >= workers * 4: # Bounds the compressed data waiting to be written.
+                    file, arcname, future = pending.popleft()
+                    total += write_deflated(zipf, file, arcname, future.result())
+            while len(pending) > 0:
+                file, arcname, future = pending.popleft()
+                total += write_deflated(zipf, file, arcname, future.result())
+    return total
+
+def percentile(values, p):
+    '''
+    Returns the p-th percentile (0-100) of the values, using the nearest rank.
+    '''
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+def total_memory():
+    '''
+    Returns the physical memory of the host in bytes, None if it can't be determined.
+    '''
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        import ctypes # Windows
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [('length', ctypes.c_ulong), ('load', ctypes.c_ulong), ('total_phys', ctypes.c_ulonglong), ('avail_phys', ctypes.c_ulonglong), ('total_page', ctypes.c_ulonglong), ('avail_page', ctypes.c_ulonglong), ('total_virtual', ctypes.c_ulonglong), ('avail_virtual', ctypes.c_ulonglong), ('avail_extended', ctypes.c_ulonglong)]
+        status = MemoryStatus()
+        status.length = ctypes.sizeof(MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.total_phys
+    except (AttributeError, OSError):
+        pass
+    return None